@@ -1,16 +1,25 @@
+import logging
 import os
+from logging.handlers import RotatingFileHandler
 
 import click
-from flask import Flask, render_template
+from flask import Flask, g, render_template
 from flask_login import current_user
 from flask_wtf.csrf import CSRFError
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from bluelog.blueprints.admin import admin_bp
 from bluelog.blueprints.auth import auth_bp
 from bluelog.blueprints.blog import blog_bp
+from bluelog.assets import assets
+from bluelog.caching import site_cache, page_cache
+from bluelog.database import init_database
 from bluelog.extensions import db, moment, bootstrap, ckeditor, mail, login_manager, csrf
+from bluelog.instrumentation import profiler
+from bluelog.ratelimit import limiter
+from bluelog.search import FTS_TABLE, create_search_table, drop_search_table
 from bluelog.settings import config
-from bluelog.models import Admin, Category, Comment, Link
+from bluelog.models import Admin, ArchiveMonth, Category, Post, Tag
 
 
 def create_app(config_name=None):
@@ -19,6 +28,10 @@ def create_app(config_name=None):
 
     app = Flask('bluelog')
     app.config.from_object(config[config_name])
+    if app.config['BLUELOG_PROXY_FIX']:
+        # Otherwise remote_addr is the proxy and every client shares its rate limit buckets.
+        proxies = app.config['BLUELOG_PROXY_FIX']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies, x_host=proxies)
 
     register_logging(app)
     register_extensions(app)
@@ -32,17 +45,44 @@ def create_app(config_name=None):
 
 
 def register_logging(app):
-    pass
+    app.logger.setLevel(logging.INFO)
+    profile_logger = logging.getLogger('bluelog.profile')
+    profile_logger.setLevel(logging.INFO)
+    # profiles go to profile.log only, not to the root handlers as well
+    profile_logger.propagate = False
+
+    if not app.debug and not app.testing:
+        log_dir = os.path.join(os.path.dirname(app.root_path), 'logs')
+        os.makedirs(log_dir, exist_ok=True)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        file_handler = RotatingFileHandler(os.path.join(log_dir, 'bluelog.log'),
+                                           maxBytes=10 * 1024 * 1024, backupCount=10)
+        file_handler.setFormatter(formatter)
+        file_handler.setLevel(logging.INFO)
+        app.logger.addHandler(file_handler)
+
+        # one JSON object per line, so the request profiles can be fed to log tooling as they are
+        profile_handler = RotatingFileHandler(os.path.join(log_dir, 'profile.log'),
+                                              maxBytes=10 * 1024 * 1024, backupCount=10)
+        profile_handler.setFormatter(logging.Formatter('%(message)s'))
+        profile_logger.addHandler(profile_handler)
+
+    profiler.init_app(app)
 
 
 def register_extensions(app):
     bootstrap.init_app(app)
+    init_database(app)
     db.init_app(app)
     moment.init_app(app)
     ckeditor.init_app(app)
     mail.init_app(app)
     login_manager.init_app(app)
     csrf.init_app(app)
+    site_cache.init_app(app)
+    page_cache.init_app(app)
+    assets.init_app(app)
+    limiter.init_app(app)
 
 
 def register_blueprints(app):
@@ -60,14 +100,17 @@ def register_shell_context(app):
 def register_template_context(app):
     @app.context_processor
     def make_template_context():
-        admin = Admin.query.first()
-        categories = Category.query.order_by(Category.name).all()
-        links = Link.query.order_by(Link.name).all()
+        admin = site_cache.get('admin')
+        categories = site_cache.get('categories')
+        archive = site_cache.get('archive')
+        tags = site_cache.get('tags')
+        links = site_cache.get('links')
         if current_user.is_authenticated:
-            unread_comments = Comment.query.filter_by(reviewed=False).count()
+            unread_comments = site_cache.get('unread_comments')
         else:
             unread_comments = None
-        return dict(admin=admin, categories=categories, links=links, unread_comments=unread_comments)
+        return dict(admin=admin, categories=categories, archive=archive, tags=tags, links=links,
+                    unread_comments=unread_comments)
 
 
 def register_errors(app):
@@ -79,6 +122,13 @@ def register_errors(app):
     def page_not_found(e):
         return render_template('errors/404.html'), 404
 
+    @app.errorhandler(429)
+    def too_many_requests(e):
+        response = app.make_response((render_template('errors/429.html'), 429))
+        if g.get('retry_after'):
+            response.headers['Retry-After'] = str(g.retry_after)
+        return response
+
     @app.errorhandler(500)
     def internal_server_error(e):
         return render_template('errors/500.html'), 500
@@ -94,11 +144,46 @@ def register_commands(app):
     def initdb(drop):
         if drop:
             click.confirm('Confirm to delete the database?', abort=True)
+            drop_search_table()
             db.drop_all()
             click.echo('Deleted database')
         db.create_all()
+        create_search_table()
+        site_cache.invalidate('admin', 'principal', 'categories', 'archive', 'tags', 'links', 'unread_comments')
+        page_cache.purge('site')
         click.echo('Initialized database')
 
+    @app.cli.command()
+    def upgradedb():
+        """Add missing tables, columns and indexes to an existing database"""
+        from bluelog.schema import upgrade_database
+
+        changes = upgrade_database()
+        if create_search_table():
+            changes.append(('table', FTS_TABLE))
+        for kind, name in changes:
+            click.echo('Added %s %s' % (kind, name))
+        added = set(name for kind, name in changes)
+        # Before anything below updates posts and the column's onupdate stamps them.
+        if 'post.last_modified' in added:
+            Post.query.filter(Post.last_modified.is_(None)).\
+                update({'last_modified': Post.timestamp}, synchronize_session=False)
+            db.session.commit()
+        if added & {'category.post_count', 'post.comment_count', 'post.reviewed_comment_count'}:
+            click.echo('Rebuilding counters...')
+            Category.recount()
+            Post.recount()
+            db.session.commit()
+        if 'archive_month' in added:
+            click.echo('Counting posts per month...')
+            ArchiveMonth.rebuild()
+            db.session.commit()
+        if 'post.body_html' in added:
+            click.echo('Rendered %d posts.' % Post.render_bodies())
+        site_cache.invalidate('admin', 'principal', 'categories', 'archive', 'tags', 'links', 'unread_comments')
+        page_cache.purge('site')
+        click.echo('Database is up to date.' if changes else 'Nothing to upgrade.')
+
     @app.cli.command()
     @click.option('--username', prompt=True, help='Admin username')
     @click.option('--password', prompt=True, hide_input=True,
@@ -109,40 +194,207 @@ def register_commands(app):
             click.echo('The administrator exists, updating...')
             admin.username = username
             admin.set_password(password)
-        click.echo('Creating admin account...')
-        admin = Admin(
-            username=username,
-            blog_title='A blog',
-            blog_subtitle='hakuna matata',
-            name='Timon',
-            about='Lion king baby'
-        )
-        admin.password_hash = admin.set_password(password)
-        db.session.add(admin)
+        else:
+            click.echo('Creating admin account...')
+            admin = Admin(
+                username=username,
+                blog_title='A blog',
+                blog_subtitle='hakuna matata',
+                name='Timon',
+                about='Lion king baby'
+            )
+            admin.set_password(password)
+            db.session.add(admin)
         db.session.commit()
+        site_cache.invalidate('admin', 'principal')
+        page_cache.purge('site')
         click.echo('Done')
 
     @app.cli.command()
-    @click.option('--category', default=10)
-    @click.option('--post', default=50)
-    @click.option('--comment', default=500)
-    def forge(category, post, comment):
+    def recount():
+        """Rebuild the post and comment counters"""
+        click.echo('Counting posts per category...')
+        Category.recount()
+        click.echo('Counting comments per post...')
+        Post.recount()
+        click.echo('Counting posts per month...')
+        ArchiveMonth.rebuild()
+        click.echo('Counting posts per tag...')
+        Tag.recount()
+        db.session.commit()
+        site_cache.invalidate('categories', 'archive', 'tags')
+        page_cache.purge('site')
+        click.echo('Done.')
+
+    @app.cli.command('render-posts')
+    @click.option('--all', 'render_all', is_flag=True, help='Render every post, not only the missing ones.')
+    @click.option('--batch-size', default=500, help='Posts per transaction, default is 500.')
+    def render_posts(render_all, batch_size):
+        """Pre-render post excerpts and sanitized body HTML"""
+        rendered = Post.render_bodies(missing_only=not render_all, batch_size=batch_size)
+        page_cache.purge('site')
+        click.echo('Rendered %d posts.' % rendered)
+
+    @app.cli.command()
+    @click.option('--scale', '-s', multiple=True, type=click.Choice(['small', 'medium', 'large']),
+                  help='Data scale to measure, can be repeated, default is small.')
+    @click.option('--iterations', default=50, help='Requests per endpoint, default is 50.')
+    @click.option('--baseline', type=click.Path(exists=True), help='Fail when slower than this report.')
+    @click.option('--tolerance', default=0.2, help='Allowed p95 slowdown against the baseline, default is 0.2.')
+    @click.option('--save', type=click.Path(), help='Write the report as a new baseline.')
+    @click.option('--concurrency', type=int, help='Instead, measure this many readers against a comment writer.')
+    @click.option('--posters', type=int, help='Instead, measure this many concurrent comment posters.')
+    @click.option('--duration', default=5.0, help='Seconds of the concurrency run, default is 5.')
+    def benchmark(scale, iterations, baseline, tolerance, save, concurrency, posters, duration):
+        """Measure latency, SQL statements and memory of the main endpoints"""
+        from bluelog.benchmark import run, format_report, compare, load_baseline, save_baseline, \
+            run_concurrency, format_concurrency, run_ingest, format_ingest
+
+        if posters:
+            for name in scale or ['small']:
+                click.echo('[%s] %d comment posters, %.0f s' % (name, posters, duration))
+                click.echo(format_ingest(run_ingest(name, posters=posters, duration=duration)))
+            return
+        if concurrency:
+            for name in scale or ['small']:
+                click.echo('[%s] %d readers, 1 comment writer, %.0f s' % (name, concurrency, duration))
+                click.echo(format_concurrency(run_concurrency(name, readers=concurrency, duration=duration)))
+            return
+        report = run(scale or ['small'], iterations=iterations)
+        click.echo(format_report(report))
+        if save:
+            save_baseline(report, save)
+            click.echo('Saved baseline to %s' % save)
+        if baseline:
+            regressions = compare(report, load_baseline(baseline), tolerance)
+            for regression in regressions:
+                click.echo('REGRESSION %s' % regression, err=True)
+            if regressions:
+                raise SystemExit(1)
+            click.echo('No regression against %s' % baseline)
+
+    @app.cli.command('flush-comments')
+    def flush_comments():
+        """Write the comments waiting in the buffer"""
+        from bluelog.ingest import SpoolBuffer, comment_buffer, drain
+
+        buffer = comment_buffer(app)
+        if isinstance(buffer, SpoolBuffer):
+            click.echo('Released %d stale claims.' % buffer.release_stale())
+        click.echo('Wrote %d comments.' % drain(buffer))
+
+    @app.cli.command()
+    def reindex():
+        """Rebuild the full-text search index"""
+        from bluelog.search import reindex as rebuild_index
+
+        click.echo('Indexing posts and comments...')
+        posts, comments = rebuild_index()
+        click.echo('Indexed %d posts and %d comments.' % (posts, comments))
+
+    @app.cli.command('build-assets')
+    @click.option('--clean', is_flag=True, help='Remove the files of earlier builds.')
+    def build_assets(clean):
+        """Bundle, fingerprint and precompress the static assets"""
+        from bluelog.assets import build, brotli
+
+        manifest = build(app, clean=clean)
+        for name, filename in sorted(manifest.items()):
+            click.echo('%s -> %s' % (name, filename))
+        if brotli is None:
+            click.echo('brotli is not installed, only gzip copies were written.')
+        page_cache.purge('site')
+        click.echo('Done.')
+
+    @app.cli.command('export-static')
+    @click.option('--output', '-o', help='Target directory, default is BLUELOG_EXPORT_PATH.')
+    @click.option('--incremental', is_flag=True, help='Only render pages changed since the last export.')
+    @click.option('--workers', default=1, help='Processes rendering pages, default is 1.')
+    def export_static(output, incremental, workers):
+        """Render the public pages to static HTML files"""
+        from bluelog.export import export_site
+
+        output = output or app.config['BLUELOG_EXPORT_PATH']
+        click.echo('Exporting to %s...' % output)
+
+        def progress(done, total):
+            if done % 100 == 0 or done == total:
+                click.echo('  %d/%d pages' % (done, total))
+
+        rendered, removed, failed = export_site(app, output, incremental=incremental, workers=workers,
+                                                progress=progress)
+        for url, status in failed:
+            click.echo('Failed %s: %d' % (url, status), err=True)
+        click.echo('Rendered %d pages, removed %d.' % (rendered, removed))
+        if failed:
+            raise SystemExit(1)
+
+    @app.cli.command('mail-worker')
+    @click.option('--workers', default=1, help='Number of worker threads')
+    @click.option('--once', is_flag=True, help='Send the due messages and exit')
+    def mail_worker(workers, once):
+        """Deliver queued emails"""
+        from bluelog.mailqueue import drain, start_workers
+
+        if once:
+            click.echo('Sent %d messages.' % drain())
+            return
+        click.echo('Starting %d mail worker(s), press Ctrl+C to stop...' % workers)
+        stop, threads = start_workers(app, workers, daemon=False)
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(1)
+        except KeyboardInterrupt:
+            stop.set()
+            click.echo('Stopping...')
+            for thread in threads:
+                thread.join()
+
+    @app.cli.command()
+    @click.option('--category', default=10, help='Quantity of categories, default is 10.')
+    @click.option('--post', default=50, help='Quantity of posts, default is 50.')
+    @click.option('--comment', default=500, help='Quantity of comments, default is 500.')
+    @click.option('--seed', type=int, help='Seed for reproducible data.')
+    @click.option('--workers', default=1, help='Processes generating rows, default is 1.')
+    @click.option('--chunk-size', default=5000, help='Rows per insert and commit, default is 5000.')
+    @click.option('--unreviewed', default=0.1, help='Ratio of unreviewed comments, default is 0.1.')
+    @click.option('--replies', default=0.1, help='Ratio of comments that reply to another one, default is 0.1.')
+    @click.option('--reindex/--no-reindex', default=True, help='Build the search index afterwards.')
+    def forge(category, post, comment, seed, workers, chunk_size, unreviewed, replies, reindex):
         """Generate fake information"""
-        from bluelog.fakes import fake_admin, fake_category, fake_post, fake_comments
+        from bluelog.fakes import fake_admin, fake_category, fake_post, fake_comments, rebuild_aggregates
 
+        drop_search_table()
         db.drop_all()
         db.create_all()
+        create_search_table()
 
         click.echo('Generating fake admin...')
         fake_admin()
 
         click.echo('Generating %d fake categories...' % category)
-        fake_category(category)
+        fake_category(category, seed=seed)
 
         click.echo('Generating %d fake posts...' % post)
-        fake_post(post)
+        with click.progressbar(length=post) as bar:
+            fake_post(post, seed=seed, workers=workers, chunk_size=chunk_size,
+                      progress=lambda done: bar.update(done - bar.pos))
 
         click.echo('Generating %d fake comments...' % comment)
-        fake_comments(comment)
+        with click.progressbar(length=comment) as bar:
+            fake_comments(comment, seed=seed, workers=workers, chunk_size=chunk_size, unreviewed=unreviewed,
+                          replies=replies, progress=lambda done: bar.update(done - bar.pos))
+
+        click.echo('Counting posts and comments...')
+        rebuild_aggregates()
+
+        if reindex:
+            from bluelog.search import reindex as rebuild_index
+
+            click.echo('Building the search index...')
+            rebuild_index()
 
+        site_cache.invalidate('admin', 'principal', 'categories', 'archive', 'tags', 'links', 'unread_comments')
+        page_cache.purge('site')
         click.echo('Done.')
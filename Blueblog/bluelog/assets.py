@@ -0,0 +1,135 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import uuid
+
+from flask import current_app, request, send_file, url_for
+from werkzeug.exceptions import NotFound
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+MANIFEST = 'manifest.json'
+# Logical name: source files under the static folder, joined in this order.
+BUNDLES = {
+    'js/site.js': ['js/jquery-3.2.1.slim.min.js', 'js/popper.min.js', 'js/bootstrap.min.js', 'js/script.js'],
+    'js/moment.js': ['js/moment-with-locales.min.js'],
+}
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def bundles(app):
+    """The fixed bundles plus one stylesheet per theme, the theme with the site's own rules."""
+    result = dict(BUNDLES)
+    for theme in app.config['BLUELOG_THEMES']:
+        result['css/%s.css' % theme] = ['css/%s.min.css' % theme, 'css/style.css']
+    return result
+
+
+def _write(path, data):
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def build(app, clean=False):
+    """Write every bundle fingerprinted, with gzip (and brotli, when installed) copies.
+
+    Returns the new manifest. Files of earlier builds are kept for pages that
+    still reference them, unless ``clean`` is given.
+    """
+    output = app.config['BLUELOG_ASSETS_PATH']
+    os.makedirs(output, exist_ok=True)
+    manifest = {}
+    for name, sources in sorted(bundles(app).items()):
+        separator = b'\n;\n' if name.endswith('.js') else b'\n'
+        parts = []
+        for source in sources:
+            with open(os.path.join(app.static_folder, source), 'rb') as f:
+                parts.append(f.read().strip())
+        data = separator.join(parts) + b'\n'
+        base, extension = os.path.splitext(os.path.basename(name))
+        filename = '%s.%s%s' % (base, hashlib.sha256(data).hexdigest()[:12], extension)
+        path = os.path.join(output, filename)
+        if not os.path.exists(path):
+            _write(path, data)
+            _write(path + '.gz', gzip.compress(data, 9))
+            if brotli is not None:
+                _write(path + '.br', brotli.compress(data))
+        manifest[name] = filename
+    _write(os.path.join(output, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    if clean:
+        keep = set(manifest.values()) | {MANIFEST}
+        for filename in os.listdir(output):
+            if (filename[:-3] if filename.endswith(('.gz', '.br')) else filename) not in keep:
+                os.remove(os.path.join(output, filename))
+    app.extensions['assets'].clear()
+    return manifest
+
+
+class Assets(object):
+    """Resolves logical asset names to fingerprinted files and serves them precompressed."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['assets'] = {}
+        app.add_url_rule('/assets/<path:filename>', 'assets', self.serve)
+        app.add_template_global(self.asset_url)
+        app.add_template_global(self.asset_urls)
+
+    def manifest(self):
+        state = current_app.extensions['assets']
+        path = os.path.join(current_app.config['BLUELOG_ASSETS_PATH'], MANIFEST)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if state.get('mtime') != mtime:
+            with open(path) as f:
+                state.update(manifest=json.load(f), mtime=mtime)
+        return state['manifest']
+
+    def asset_urls(self, name):
+        """URLs to include for ``name``: the built bundle, or its sources before ``flask build-assets`` ran."""
+        manifest = self.manifest()
+        if manifest is not None and name in manifest:
+            return [url_for('assets', filename=manifest[name])]
+        return [url_for('static', filename=source) for source in bundles(current_app)[name]]
+
+    def asset_url(self, name):
+        urls = self.asset_urls(name)
+        if len(urls) != 1:
+            raise ValueError('%s is a bundle of %d files, use asset_urls()' % (name, len(urls)))
+        return urls[0]
+
+    def serve(self, filename):
+        output = current_app.config['BLUELOG_ASSETS_PATH']
+        if filename == MANIFEST or filename.endswith(('.gz', '.br')) or '/' in filename:
+            raise NotFound()
+        path = os.path.join(output, filename)
+        if not os.path.isfile(path):
+            raise NotFound()
+        encoding = None
+        for name, suffix in ENCODINGS:
+            # The quality is 0 for an encoding refused with q=0 or not listed at all.
+            if request.accept_encodings[name] and os.path.isfile(path + suffix):
+                path, encoding = path + suffix, name
+                break
+        response = send_file(path, mimetype=mimetypes.guess_type(filename)[0], conditional=True)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        # The file name changes with the content, so it can be cached forever.
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+
+
+assets = Assets()
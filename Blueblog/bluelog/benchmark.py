@@ -0,0 +1,361 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from sqlalchemy import event
+
+from bluelog.extensions import db
+
+SCALES = {
+    # name: (categories, posts, comments)
+    'small': (10, 100, 1000),
+    'medium': (20, 2000, 20000),
+    'large': (50, 20000, 200000),
+}
+
+
+class QueryCounter(object):
+    """Counts the SQL statements an engine executes while it is active."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _before_cursor_execute(self, *args, **kwargs):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def build_app(scale, workdir, seed=42, sqlite_pragmas=None):
+    """An app on a file-backed SQLite database seeded with the ``forge`` generators."""
+    from bluelog import create_app
+    from bluelog.database import engine_options
+    from bluelog.fakes import fake_admin, fake_category, fake_post, fake_comments, rebuild_aggregates
+
+    app = create_app('testing')
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(workdir, 'bench.db'),
+        BLUELOG_SQLITE_PRAGMAS=sqlite_pragmas or {},
+    )
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(dict(app.config, SQLALCHEMY_ENGINE_OPTIONS=None))
+    categories, posts, comments = SCALES[scale]
+    with app.app_context():
+        db.create_all()
+        fake_admin()
+        fake_category(categories, seed=seed)
+        fake_post(posts, seed=seed)
+        fake_comments(comments, seed=seed)
+        rebuild_aggregates()
+    return app
+
+
+def endpoints(app):
+    """(name, method, url, form data, needs login) of every measured request."""
+    from bluelog.models import Category, Post
+
+    with app.app_context():
+        post_count = Post.query.count()
+        post_id = db.session.query(Post.id).order_by(Post.reviewed_comment_count.desc()).first()[0]
+        category_id = db.session.query(Category.id).order_by(Category.post_count.desc()).first()[0]
+    comment = dict(author='Bench', email='bench@example.com', site='', body='Benchmark comment')
+    return [
+        ('blog.index', 'GET', '/', None, False),
+        ('blog.index deep', 'GET', '/?page=%d' % max(post_count // app.config['BLUELOG_POST_PER_PAGE'], 1),
+         None, False),
+        ('blog.show_post', 'GET', '/post/%d' % post_id, None, False),
+        ('blog.show_category', 'GET', '/category/%d' % category_id, None, False),
+        ('admin.manage_post', 'GET', '/admin/post/manage', None, True),
+        ('admin.manage_comment', 'GET', '/admin/comment/manage', None, True),
+        ('comment POST', 'POST', '/post/%d' % post_id, comment, False),
+    ]
+
+
+def measure(app, iterations=50, warmup=3):
+    results = {}
+    anonymous = app.test_client()
+    admin = app.test_client()
+    admin.post('/auth/login', data=dict(username='admin', password='fakeadmin'))
+
+    for name, method, url, data, needs_login in endpoints(app):
+        client = admin if needs_login else anonymous
+        request = (lambda: client.post(url, data=data)) if method == 'POST' else (lambda: client.get(url))
+        for i in range(warmup):
+            request()
+
+        timings, queries = [], []
+        with app.app_context():
+            engine = db.engine
+        for i in range(iterations):
+            with QueryCounter(engine) as counter:
+                start = time.perf_counter()
+                response = request()
+                timings.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                raise RuntimeError('%s %s returned %d' % (method, url, response.status_code))
+            queries.append(counter.count)
+
+        tracemalloc.start()
+        request()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results[name] = dict(
+            p50_ms=round(percentile(timings, 0.5), 3),
+            p95_ms=round(percentile(timings, 0.95), 3),
+            queries=max(queries),
+            peak_kb=round(peak / 1024.0, 1),
+        )
+    return results
+
+
+def run(scales, iterations=50, seed=42):
+    report = {}
+    for scale in scales:
+        workdir = tempfile.mkdtemp(prefix='bluelog-bench-')
+        try:
+            app = build_app(scale, workdir, seed=seed)
+            report[scale] = measure(app, iterations=iterations)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def measure_concurrency(app, readers=4, duration=5.0):
+    """Read latency of anonymous page views while one client keeps posting comments."""
+    urls = [url for name, method, url, data, needs_login in endpoints(app) if method == 'GET' and not needs_login]
+    post_url, comment = [(url, data) for name, method, url, data, needs_login in endpoints(app)
+                         if method == 'POST'][0]
+    stop = threading.Event()
+    timings, errors, writes = [], [], [0]
+    lock = threading.Lock()
+
+    def write():
+        client = app.test_client()
+        while not stop.is_set():
+            response = client.post(post_url, data=comment)
+            with lock:
+                if response.status_code >= 400:
+                    errors.append('POST %d' % response.status_code)
+                else:
+                    writes[0] += 1
+
+    def read(offset):
+        client = app.test_client()
+        index = offset
+        while not stop.is_set():
+            url = urls[index % len(urls)]
+            index += 1
+            start = time.perf_counter()
+            try:
+                response = client.get(url)
+                status = response.status_code
+            except Exception as e:
+                status = repr(e)
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                timings.append(elapsed)
+                if status != 200:
+                    errors.append('GET %s' % status)
+
+    threads = [threading.Thread(target=write)] + [threading.Thread(target=read, args=(i,)) for i in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return dict(
+        reads=len(timings),
+        writes=writes[0],
+        read_p50_ms=round(percentile(timings, 0.5), 3),
+        read_p95_ms=round(percentile(timings, 0.95), 3),
+        read_max_ms=round(max(timings) if timings else 0.0, 3),
+        errors=len(errors),
+    )
+
+
+def reads_during_write(app):
+    """Whether a second connection can read while another one holds the write lock of the database."""
+    import sqlite3
+
+    with app.app_context():
+        writer, reader = db.engine.raw_connection(), db.engine.raw_connection()
+        try:
+            # EXCLUSIVE keeps readers out of a rollback journal database, WAL lets them through.
+            writer.cursor().execute('BEGIN EXCLUSIVE')
+            writer.cursor().execute('UPDATE post SET title = title')
+            cursor = reader.cursor()
+            cursor.execute('PRAGMA busy_timeout = 0')
+            try:
+                cursor.execute('SELECT count(*) FROM post').fetchone()
+            except sqlite3.OperationalError:
+                return False
+            return True
+        finally:
+            writer.rollback()
+            # The reader had its busy timeout changed, it must not go back to the pool.
+            reader.invalidate()
+            reader.close()
+            writer.close()
+
+
+def run_concurrency(scale, readers=4, duration=5.0, seed=42):
+    """Compare the SQLite defaults with the production pragmas under a concurrent comment writer."""
+    from bluelog.settings import ProductionConfig
+
+    report = {}
+    for name, pragmas in (('default', None), ('production', ProductionConfig.BLUELOG_SQLITE_PRAGMAS)):
+        workdir = tempfile.mkdtemp(prefix='bluelog-bench-')
+        try:
+            app = build_app(scale, workdir, seed=seed, sqlite_pragmas=pragmas)
+            report[name] = measure_concurrency(app, readers=readers, duration=duration)
+            report[name]['reads_during_write'] = reads_during_write(app)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if not report['production']['reads_during_write']:
+        raise AssertionError('Readers are blocked by a writer with the production pragmas, WAL is not in effect')
+    return report
+
+
+def format_concurrency(report):
+    lines = ['%-12s %8s %8s %10s %10s %10s %8s %14s' % ('pragmas', 'reads', 'writes', 'p50 ms', 'p95 ms',
+                                                        'max ms', 'errors', 'read in write')]
+    for name, result in report.items():
+        lines.append('%-12s %8d %8d %10.2f %10.2f %10.2f %8d %14s' % (
+            name, result['reads'], result['writes'], result['read_p50_ms'], result['read_p95_ms'],
+            result['read_max_ms'], result['errors'], 'yes' if result['reads_during_write'] else 'no'))
+    return '\n'.join(lines)
+
+
+def measure_ingest(app, posters=4, duration=5.0):
+    """Throughput and latency of concurrent comment posters, then the time to write what was buffered."""
+    from bluelog.ingest import drain, stop_flusher
+    from bluelog.models import Comment
+
+    post_url, comment = [(url, data) for name, method, url, data, needs_login in endpoints(app)
+                         if method == 'POST'][0]
+    with app.app_context():
+        before = Comment.query.count()
+    stop = threading.Event()
+    timings, errors = [], []
+    lock = threading.Lock()
+
+    def post():
+        client = app.test_client()
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                status = client.post(post_url, data=comment).status_code
+            except Exception as e:
+                status = repr(e)
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                timings.append(elapsed)
+                if status != 302:
+                    errors.append('POST %s' % status)
+
+    threads = [threading.Thread(target=post) for i in range(posters)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stop_flusher(app)
+    with app.app_context():
+        if app.config['BLUELOG_COMMENT_BUFFER']:
+            drain()
+        written = Comment.query.count() - before
+    return dict(
+        posts=len(timings),
+        posts_per_s=round(len(timings) / elapsed, 1),
+        post_p50_ms=round(percentile(timings, 0.5), 3),
+        post_p95_ms=round(percentile(timings, 0.95), 3),
+        settle_s=round(time.perf_counter() - started - elapsed, 3),
+        written=written,
+        errors=len(errors),
+    )
+
+
+def run_ingest(scale, posters=4, duration=5.0, seed=42):
+    """Compare writing each comment in its request with the memory and disk buffers."""
+    report = {}
+    for mode in (None, 'memory', 'disk'):
+        workdir = tempfile.mkdtemp(prefix='bluelog-bench-')
+        try:
+            app = build_app(scale, workdir, seed=seed)
+            app.config.update(BLUELOG_COMMENT_BUFFER=mode,
+                              BLUELOG_COMMENT_SPOOL_DIR=os.path.join(workdir, 'comment-spool'))
+            report[mode or 'direct'] = measure_ingest(app, posters=posters, duration=duration)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def format_ingest(report):
+    lines = ['%-8s %8s %8s %10s %10s %10s %8s %8s' % ('buffer', 'posts', 'posts/s', 'p50 ms', 'p95 ms',
+                                                      'settle s', 'written', 'errors')]
+    for name, result in report.items():
+        lines.append('%-8s %8d %8.1f %10.2f %10.2f %10.2f %8d %8d' % (
+            name, result['posts'], result['posts_per_s'], result['post_p50_ms'], result['post_p95_ms'],
+            result['settle_s'], result['written'], result['errors']))
+    return '\n'.join(lines)
+
+
+def compare(report, baseline, tolerance=0.2):
+    """List the endpoints that got slower than ``tolerance`` or issue more queries than the baseline."""
+    regressions = []
+    for scale, results in report.items():
+        for name, result in results.items():
+            previous = baseline.get(scale, {}).get(name)
+            if previous is None:
+                continue
+            if result['queries'] > previous['queries']:
+                regressions.append('%s %s: %d queries, baseline %d' %
+                                   (scale, name, result['queries'], previous['queries']))
+            if result['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+                regressions.append('%s %s: p95 %.1f ms, baseline %.1f ms' %
+                                   (scale, name, result['p95_ms'], previous['p95_ms']))
+    return regressions
+
+
+def format_report(report):
+    lines = []
+    for scale, results in report.items():
+        lines.append('[%s]' % scale)
+        lines.append('%-24s %10s %10s %8s %10s' % ('endpoint', 'p50 ms', 'p95 ms', 'queries', 'peak KB'))
+        for name, result in results.items():
+            lines.append('%-24s %10.2f %10.2f %8d %10.1f' % (name, result['p50_ms'], result['p95_ms'],
+                                                             result['queries'], result['peak_kb']))
+    return '\n'.join(lines)
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
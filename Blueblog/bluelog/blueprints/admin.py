@@ -1,12 +1,18 @@
-import os
-
-from flask import Blueprint, flash, redirect, url_for, render_template, request, current_app, send_from_directory
+from flask import Blueprint, flash, redirect, url_for, render_template, request, current_app, jsonify
 from flask_ckeditor import upload_fail, upload_success
 from flask_login import login_required, current_user
 
+from bluelog.caching import site_cache, page_cache
 from bluelog.extensions import db
 from bluelog.forms import SettingForm, PostForm, CategoryForm, LinkForm
-from bluelog.models import Post, Category, Comment, Link
+from bluelog.instrumentation import profiler
+from bluelog.loaders import with_profile
+from bluelog.models import Admin, Post, Category, Comment, Link
+from bluelog.moderation import parse_criteria, approve_comments, delete_comments
+from bluelog.pagination import paginate
+from bluelog.ratelimit import limiter
+from bluelog.search import index_post, remove_post, index_comment, remove_comment
+from bluelog.uploads import store_upload, schedule_variants, serve_upload
 from bluelog.utils import redirect_back, allowed_file
 
 admin_bp = Blueprint('admin', __name__)
@@ -16,27 +22,31 @@ admin_bp = Blueprint('admin', __name__)
 @login_required
 def settings():
     form = SettingForm()
+    # current_user is the cached principal, edits go to the row itself.
+    admin = Admin.query.get_or_404(current_user.id)
     if form.validate_on_submit():
-        current_user.name = form.name.data
-        current_user.blog_title = form.blog_title.data
-        current_user.blog_subtitle = form.blog_subtitle.data
-        current_user.about = form.about.data
+        admin.name = form.name.data
+        admin.blog_title = form.blog_title.data
+        admin.blog_subtitle = form.blog_subtitle.data
+        admin.about = form.about.data
         db.session.commit()
+        site_cache.invalidate('admin', 'principal')
+        page_cache.purge('site')
         flash('Settings updated!', 'success')
         return redirect(url_for('blog.index'))
-    form.name.data = current_user.name
-    form.blog_title.data = current_user.blog_title
-    form.blog_subtitle.data = current_user.blog_subtitle
-    form.about.data = current_user.about
-    return render_template('admin/settings.html')
+    form.name.data = admin.name
+    form.blog_title.data = admin.blog_title
+    form.blog_subtitle.data = admin.blog_subtitle
+    form.about.data = admin.about
+    return render_template('admin/settings.html', form=form)
 
 
 @admin_bp.route('/post/manage')
 @login_required
 def manage_post():
     page = request.args.get('page', 1, type=int)
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['BLUE_LOG_MANAGE_POST_PER_PAGE'])
+    pagination = with_profile(Post.query, 'post_manage').order_by(Post.timestamp.desc()).paginate(
+        page, per_page=current_app.config['BLUELOG_MANAGE_POST_PER_PAGE'])
     posts = pagination.items
     return render_template('admin/manage_post.html', page=page, pagination=pagination, posts=posts)
 
@@ -50,8 +60,14 @@ def new_post():
         category = Category.query.get(form.category.data)
         body = form.body.data
         post = Post(title=title, category=category, body=body)
+        post.render_body()
         db.session.add(post)
+        changed_tags = post.set_tags((form.tags.data or '').split(','))
+        index_post(post)
         db.session.commit()
+        site_cache.invalidate('categories', 'archive', 'tags')
+        page_cache.purge('index', 'category:%d' % form.category.data, 'site',
+                         *['tag:%d' % tag_id for tag_id in changed_tags])
         flash('Post created', 'success')
         return redirect(url_for('blog.show_post', post_id=post.id))
     return render_template('admin/new_post.html', form=form)
@@ -61,16 +77,28 @@ def new_post():
 @login_required
 def edit_post(post_id):
     form = PostForm()
-    post = Post.query.get(post_id)
+    post = Post.query.get_or_404(post_id)
     if form.validate_on_submit():
+        old_category_id = post.category_id
         post.title = form.title.data
         post.category = Category.query.get(form.category.data)
         post.body = form.body.data
+        post.render_body()
+        changed_tags = post.set_tags((form.tags.data or '').split(','))
+        index_post(post)
         db.session.commit()
+        page_cache.purge('post:%d' % post_id, *['tag:%d' % tag_id for tag_id in changed_tags])
+        if changed_tags:
+            site_cache.invalidate('tags')
+            page_cache.purge('site')
+        if post.category_id != old_category_id:
+            site_cache.invalidate('categories')
+            page_cache.purge('category:%d' % old_category_id, 'category:%d' % post.category_id, 'site')
         flash('Post updated', 'success')
         return redirect(url_for('blog.show_post', post_id=post.id))
     form.title.data = post.title
     form.category.data = post.category_id
+    form.tags.data = ', '.join(tag.name for tag in post.tags)
     form.body.data = post.body
     return render_template('admin/edit_post.html', form=form)
 
@@ -79,8 +107,14 @@ def edit_post(post_id):
 @login_required
 def delete_post(post_id):
     post = Post.query.get_or_404(post_id)
+    category_id = post.category_id
+    changed_tags = post.set_tags([])
+    remove_post(post)
     db.session.delete(post)
     db.session.commit()
+    site_cache.invalidate('categories', 'archive', 'tags', 'unread_comments')
+    page_cache.purge('post:%d' % post_id, 'index', 'category:%d' % category_id, 'site',
+                     *['tag:%d' % tag_id for tag_id in changed_tags])
     flash('Post deleted.', 'success')
     return redirect_back()
 
@@ -96,6 +130,7 @@ def set_comment(post_id):
         post.can_comment = True
         flash('Comment enabled', 'success')
     db.session.commit()
+    page_cache.purge('post:%d' % post_id)
     return redirect_back()
 
 
@@ -103,15 +138,14 @@ def set_comment(post_id):
 @login_required
 def manage_comment():
     filter_rule = request.args.get('filter', 'all')
-    page = request.args.get('page', 1, type=int)
-    per_page = current_app.config['BLUE_LOG_COMMENT_PER_PAGE']
+    per_page = current_app.config['BLUELOG_COMMENT_PER_PAGE']
     if filter_rule == 'unread':
         filtered_comments = Comment.query.filter_by(reviewed=False)
-    if filter_rule == 'admin':
+    elif filter_rule == 'admin':
         filtered_comments = Comment.query.filter_by(from_admin=True)
     else:
         filtered_comments = Comment.query
-    pagination = filtered_comments.order_by(Comment.timestamp.desc()).paginate(page, per_page=per_page)
+    pagination = paginate(with_profile(filtered_comments, 'comment_manage'), Comment, per_page)
     comments = pagination.items
     return render_template('admin/manage_comments.html', comments=comments, pagination=pagination)
 
@@ -121,21 +155,62 @@ def manage_comment():
 def approve_comment(comment_id):
     comment = Comment.query.get_or_404(comment_id)
     comment.reviewed = True
+    post_id = comment.post_id
+    index_comment(comment)
     db.session.commit()
+    site_cache.invalidate('unread_comments')
+    page_cache.purge('post:%d' % post_id)
     flash('Comment published', 'success')
     return redirect_back()
 
 
 @admin_bp.route('/comment/<int:comment_id>/delete', methods=['POST'])
 @login_required
-def manage_post(comment_id):
+def delete_comment(comment_id):
     comment = Comment.query.get_or_404(comment_id)
+    post_id, reviewed = comment.post_id, comment.reviewed
+    remove_comment(comment)
     db.session.delete(comment)
     db.session.commit()
+    site_cache.invalidate('unread_comments')
+    if reviewed:
+        page_cache.purge('post:%d' % post_id)
     flash('Comment deleted', 'success')
     return redirect_back()
 
 
+def _moderate(action, message):
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+    else:
+        data = request.form.to_dict()
+        data['ids'] = request.form.getlist('ids')
+    try:
+        criteria = parse_criteria(data)
+    except ValueError as e:
+        if request.is_json:
+            return jsonify(error=str(e)), 400
+        flash(str(e), 'warning')
+        return redirect_back()
+    counts = action(criteria)
+    if request.is_json:
+        return jsonify(**counts)
+    flash(message % counts, 'success')
+    return redirect_back()
+
+
+@admin_bp.route('/comments/approve', methods=['POST'])
+@login_required
+def approve_comments_bulk():
+    return _moderate(approve_comments, '%(approved)d comments published')
+
+
+@admin_bp.route('/comments/delete', methods=['POST'])
+@login_required
+def delete_comments_bulk():
+    return _moderate(delete_comments, '%(deleted)d comments deleted, %(replies)d of them replies')
+
+
 @admin_bp.route('/category/manage')
 @login_required
 def manage_category():
@@ -151,12 +226,14 @@ def new_category():
         category = Category(name=name)
         db.session.add(category)
         db.session.commit()
+        site_cache.invalidate('categories')
+        page_cache.purge('site')
         flash('Category created', 'success')
         return redirect(url_for('.manage_category'))
     return render_template('admin/new_category.html', form=form)
 
 
-@admin_bp.route('/category/<int:category_id>/edit', methodd=['GET','POST'])
+@admin_bp.route('/category/<int:category_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_category(category_id):
     form = CategoryForm()
@@ -167,20 +244,26 @@ def edit_category(category_id):
     if form.validate_on_submit():
         category.name = form.name.data
         db.session.commit()
+        site_cache.invalidate('categories')
+        page_cache.purge('site')
         flash('Category updated', 'success')
         return redirect(url_for('.manage_category'))
     form.name.data = category.name
     return render_template('admin/edit_category.html', form=form)
 
 
-@admin_bp.route('/category/<int:category_id>/edit', methodd=['POST'])
+@admin_bp.route('/category/<int:category_id>/delete', methods=['POST'])
 @login_required
 def delete_category(category_id):
     category = Category.query.get_or_404(category_id)
     if category.id == 1:
         flash('You are not allowed to delete Default category', 'warning')
-    db.session.delete(category)
-    db.commit()
+        return redirect(url_for('.manage_category'))
+    category.delete()
+    db.session.commit()
+    # Every cached page is tagged site, that covers the posts shown under their new category.
+    site_cache.invalidate('categories')
+    page_cache.purge('site')
     flash('Category deleted', 'success')
     return redirect(url_for('.manage_category'))
 
@@ -200,7 +283,9 @@ def new_link():
         url = form.url.data
         link = Link(name=name, url=url)
         db.session.add(link)
-        db.commit()
+        db.session.commit()
+        site_cache.invalidate('links')
+        page_cache.purge('site')
         flash('New link created.', 'success')
         return redirect(url_for('.manage_link'))
     return render_template('admin/new_link.html', form=form)
@@ -215,6 +300,8 @@ def edit_link(link_id):
         link.name = form.name.data
         link.url = form.url.data
         db.session.commit()
+        site_cache.invalidate('links')
+        page_cache.purge('site')
         flash('Link updated.', 'success')
         return redirect(url_for('.manage_link'))
     form.name.data = link.name
@@ -228,20 +315,36 @@ def delete_link(link_id):
     link = Link.query.get_or_404(link_id)
     db.session.delete(link)
     db.session.commit()
+    site_cache.invalidate('links')
+    page_cache.purge('site')
     flash('Link deleted.', 'success')
     return redirect(url_for('.manage_link'))
 
 
+@admin_bp.route('/profiling')
+@login_required
+def profiling():
+    records = profiler.history(current_app)
+    flagged = [record for record in records if record['slow_queries'] or record['n_plus_one']]
+    return render_template('admin/profiling.html', records=records, flagged=flagged, limits=limiter.stats())
+
+
 @admin_bp.route('/uploads/<path:filename>')
 def get_image(filename):
-    return send_from_directory(current_app.config['BLUELOG_UPLOAD_PATH'], filename)
+    return serve_upload(filename)
 
 
 @admin_bp.route('/upload', methods=['POST'])
+@login_required
 def upload_image():
     f = request.files.get('upload')
-    if not allowed_file(f.filename):
+    if f is None or not allowed_file(f.filename):
         return upload_fail('Image only!')
-    f.save(os.path.join(current_app.config['BLUELOG_UPLOAD_PATH'], f.filename))
-    url = url_for('.get_image', filename=f.filename)
-    return upload_success(url, f.filename)
+    try:
+        filename, created = store_upload(f)
+    except ValueError as e:
+        return upload_fail(str(e))
+    if created:
+        schedule_variants(filename)
+    url = url_for('.get_image', filename=filename)
+    return upload_success(url, filename)
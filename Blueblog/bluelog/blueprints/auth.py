@@ -1,14 +1,16 @@
 from flask import Blueprint, render_template, redirect, url_for, flash
 from flask_login import current_user, login_user, login_required, logout_user
 
-from bluelog.models import Admin
+from bluelog.caching import site_cache
 from bluelog.forms import LoginForm
+from bluelog.ratelimit import limiter
 from bluelog.utils import redirect_back
 
 auth_bp = Blueprint('auth', __name__)
 
 
 @auth_bp.route('/login', methods=['GET', 'POST'])
+@limiter.limit('login')
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('blog.index'))
@@ -18,7 +20,7 @@ def login():
         username = form.username.data
         password = form.password.data
         remember = form.remember.data
-        admin = Admin.query.first()
+        admin = site_cache.get('principal')
         if admin:
             if username == admin.username and admin.validate_password(password):
                 login_user(admin, remember)
@@ -1,30 +1,58 @@
-from flask import Blueprint, render_template, request, current_app, url_for, flash, redirect
+from flask import Blueprint, render_template, request, current_app, url_for, flash, redirect, abort, \
+    make_response
 from flask_login import current_user
 
+from bluelog.caching import site_cache, page_cache
+from bluelog.conditional import Validators, csrf_period
 from bluelog.extensions import db
+from bluelog.feeds import feed_response, sitemap_response
 from bluelog.emails import send_new_comment_email, send_new_reply_email
 from bluelog.forms import AdminCommentForm, CommentForm
-from bluelog.models import Post, Category, Comment
+from bluelog.ingest import submit_comment
+from bluelog.loaders import with_profile
+from bluelog.models import ArchiveMonth, Post, Category, Comment, Tag, post_tag
+from bluelog.utils import redirect_back
+from bluelog.pagination import paginate
+from bluelog.ratelimit import limiter
+from bluelog.search import index_comment, search as search_index
 
 blog_bp = Blueprint('blog', __name__)
 
 
 @blog_bp.route('/')
-def index():
-    page = request.args.get('page', 1, type=int)
+@blog_bp.route('/page/<page>')
+@page_cache.cached
+def index(page=None):
+    validators = Validators(*db.session.query(db.func.max(Post.last_modified), db.func.count(Post.id)).one())
+    not_modified = validators.not_modified()
+    if not_modified is not None:
+        return not_modified
+
     per_page = current_app.config['BLUELOG_POST_PER_PAGE']
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(page, per_page=per_page)
+    pagination = paginate(with_profile(Post.query, 'post_list'), Post, per_page, page)
     posts = pagination.items
-    return render_template('blog/index.html', pagination=pagination, posts=posts)
-
-
-@blog_bp.route('/post/<int:post_id>')
-def show_post(post_id):
-    post = Post.query.get_or_404(post_id)
-    page = request.args.get('page', 1, type=int)
+    page_cache.tag('index', *['post:%d' % post.id for post in posts])
+    return validators.apply(make_response(render_template('blog/index.html', pagination=pagination, posts=posts)))
+
+
+@blog_bp.route('/post/<int:post_id>', methods=['GET', 'POST'])
+@blog_bp.route('/post/<int:post_id>/page/<page>', methods=['GET', 'POST'])
+@limiter.limit('comment', exempt=lambda: current_user.is_authenticated)
+@page_cache.cached
+def show_post(post_id, page=None):
+    version = db.session.query(Post.last_modified, Post.can_comment).filter_by(id=post_id).first()
+    if version is None:
+        abort(404)
+    last_modified, can_comment = version
+    validators = Validators(last_modified, post_id, csrf_period() if can_comment else None)
+    not_modified = validators.not_modified()
+    if not_modified is not None:
+        return not_modified
+
+    post = with_profile(Post.query, 'post_page').get_or_404(post_id)
+    page_cache.tag('post:%d' % post.id)
     per_page = current_app.config['BLUELOG_COMMENT_PER_PAGE']
-    pagination = Comment.query.with_parent(post).order_by(Comment.timestamp.desc()).\
-        paginate(page=page, per_page=per_page)
+    pagination = post.comment_threads(per_page, page)
     comments = pagination.items
 
     if current_user.is_authenticated:
@@ -44,23 +72,38 @@ def show_post(post_id):
         email = form.email.data
         site = form.site.data
         body = form.body.data
+        replied_id = request.args.get('reply')
+        if replied_id:
+            replied_comment = Comment.query.get_or_404(replied_id)
+        # The admin expects to see their comment at once, readers get an acknowledgement.
+        if not from_admin and current_app.config['BLUELOG_COMMENT_BUFFER'] and submit_comment(
+                post_id=post.id, reply_id=replied_comment.id if replied_id else None, author=author, email=email,
+                site=site, body=body, from_admin=from_admin, reviewed=reviewed):
+            flash('Your comment is pending and will be published after review.', 'info')
+            return redirect(url_for('.show_post', post_id=post_id))
         comment = Comment(
             author=author, email=email, site=site, body=body, from_admin=from_admin,
             post=post, reviewed=reviewed)
-        replied_id = request.args.get('reply')
         if replied_id:
-            replied_comment = Comment.query.get_or_404('replied_id')
             comment.reply = replied_comment
-            send_new_reply_email(replied_comment)
         db.session.add(comment)
+        if reviewed:
+            index_comment(comment)
         db.session.commit()
+        if replied_id:
+            send_new_reply_email(replied_comment)
+        if reviewed:
+            page_cache.purge('post:%d' % post.id)
+        else:
+            site_cache.invalidate('unread_comments')
         if current_user.is_authenticated:
             flash('Comment published', 'success')
         else:
             flash('Your comment will be published after review.', 'info')
             send_new_comment_email(post)
         return redirect(url_for('.show_post', post_id=post_id))
-    return render_template('blog/post.html', post=post, comments=comments, pagination=pagination, form=form)
+    return validators.apply(make_response(
+        render_template('blog/post.html', post=post, comments=comments, pagination=pagination, form=form)))
 
 
 @blog_bp.route('/reply/comment/<int:comment_id>')
@@ -71,20 +114,114 @@ def reply_comment(comment_id):
 
 
 @blog_bp.route('/category/<int:category_id>')
-def show_category(category_id):
+@blog_bp.route('/category/<int:category_id>/page/<page>')
+@page_cache.cached
+def show_category(category_id, page=None):
     category = Category.query.get_or_404(category_id)
+    validators = Validators(*db.session.query(db.func.max(Post.last_modified), db.func.count(Post.id)).
+                            filter(Post.category_id == category_id).one())
+    not_modified = validators.not_modified()
+    if not_modified is not None:
+        return not_modified
+
+    per_page = current_app.config['BLUELOG_POST_PER_PAGE']
+    pagination = paginate(with_profile(Post.query.with_parent(category), 'post_list'), Post, per_page, page)
+    posts = pagination.items
+    page_cache.tag('category:%d' % category.id, *['post:%d' % post.id for post in posts])
+    return validators.apply(make_response(
+        render_template('blog/category.html', category=category, pagination=pagination, posts=posts)))
+
+
+@blog_bp.route('/tag/<int:tag_id>')
+@blog_bp.route('/tag/<int:tag_id>/page/<page>')
+@page_cache.cached
+def show_tag(tag_id, page=None):
+    tag = Tag.query.get_or_404(tag_id)
+    tagged = Post.query.join(post_tag).filter(post_tag.c.tag_id == tag_id)
+    validators = Validators(*tagged.with_entities(db.func.max(Post.last_modified), db.func.count(Post.id)).one())
+    not_modified = validators.not_modified()
+    if not_modified is not None:
+        return not_modified
 
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['BLUELOG_POST_PER_PAGE']
-    pagination = Post.query.with_parent(category).order_by(Post.timestamp.desc()).\
-        paginate(page=page, per_page=per_page)
+    pagination = paginate(with_profile(tagged, 'post_list'), Post, per_page, page)
     posts = pagination.items
-    return render_template('blog/category.html', category=category, pagination=pagination, posts=posts)
+    page_cache.tag('tag:%d' % tag.id, *['post:%d' % post.id for post in posts])
+    return validators.apply(make_response(
+        render_template('blog/tag.html', tag=tag, pagination=pagination, posts=posts)))
+
+
+@blog_bp.route('/archive')
+@page_cache.cached
+def archive():
+    # The months come from the site cache, purged with the 'site' tag like the sidebar.
+    return render_template('blog/archive.html')
+
+
+@blog_bp.route('/archive/<int:year>/<int:month>')
+@blog_bp.route('/archive/<int:year>/<int:month>/page/<page>')
+@page_cache.cached
+def show_month(year, month, page=None):
+    if not (1 <= month <= 12 and 1 <= year < 9999):
+        abort(404)
+    start, end = ArchiveMonth.bounds(year, month)
+    in_month = db.and_(Post.timestamp >= start, Post.timestamp < end)
+    last_modified, post_count = db.session.query(db.func.max(Post.last_modified), db.func.count(Post.id)).\
+        filter(in_month).one()
+    if not post_count:
+        abort(404)
+    validators = Validators(last_modified, post_count)
+    not_modified = validators.not_modified()
+    if not_modified is not None:
+        return not_modified
+
+    per_page = current_app.config['BLUELOG_POST_PER_PAGE']
+    pagination = paginate(with_profile(Post.query.filter(in_month), 'post_list'), Post, per_page, page)
+    posts = pagination.items
+    page_cache.tag('index', *['post:%d' % post.id for post in posts])
+    return validators.apply(make_response(
+        render_template('blog/month.html', month=start, post_count=post_count, pagination=pagination,
+                        posts=posts)))
+
+
+@blog_bp.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    if not q:
+        flash('Enter keyword about post or comment.', 'warning')
+        return redirect_back()
+    page = request.args.get('page', 1, type=int)
+    pagination = search_index(q, page)
+    return render_template('blog/search.html', q=q, pagination=pagination, results=pagination.items)
 
 
 @blog_bp.route('/about')
 def about():
-    return 'about page'
+    return render_template('blog/about.html')
+
+
+@blog_bp.route('/feed.xml')
+def feed():
+    return feed_response()
+
+
+@blog_bp.route('/sitemap.xml')
+def sitemap():
+    return sitemap_response()
+
+
+@blog_bp.route('/sitemap-<int:part>.xml')
+def sitemap_part(part):
+    return sitemap_response(part)
+
+
+@blog_bp.route('/change-theme/<theme_name>')
+def change_theme(theme_name):
+    if theme_name not in current_app.config['BLUELOG_THEMES']:
+        abort(404)
+    response = make_response(redirect_back())
+    response.set_cookie('theme', theme_name, max_age=30 * 24 * 60 * 60)
+    return response
 
 
 @blog_bp.route('/category/<int:category_id>')
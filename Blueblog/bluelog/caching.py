@@ -0,0 +1,369 @@
+import hashlib
+import math
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from functools import wraps
+
+from flask import current_app, g, request, session
+from flask_login import UserMixin, current_user
+from flask_wtf.csrf import generate_csrf
+from werkzeug.security import check_password_hash
+
+from bluelog.database import primary_reads
+from bluelog.models import Admin, ArchiveMonth, Category, Comment, Link, Tag
+
+AdminInfo = namedtuple('AdminInfo', ['name', 'blog_title', 'blog_subtitle', 'about'])
+CategoryInfo = namedtuple('CategoryInfo', ['id', 'name', 'post_count'])
+LinkInfo = namedtuple('LinkInfo', ['id', 'name', 'url'])
+TagInfo = namedtuple('TagInfo', ['id', 'name', 'post_count', 'weight'])
+
+
+class MonthInfo(namedtuple('MonthInfo', ['year', 'month', 'post_count'])):
+    @property
+    def label(self):
+        return datetime(self.year, self.month, 1).strftime('%B %Y')
+
+
+class Principal(UserMixin, namedtuple('Principal', ['id', 'username', 'password_hash', 'name'])):
+    """The signed in admin as Flask-Login sees it, a plain value that needs no session."""
+
+    def validate_password(self, password):
+        return check_password_hash(self.password_hash, password)
+
+
+class VersionStamp(object):
+    """A generation marker kept in a file so that every worker process sees a bump."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def bump(self):
+        # Replacing the file gives it a new inode, so the change is visible
+        # even on file systems with a coarse mtime resolution.
+        tmp_path = '%s.%s' % (self.path, uuid.uuid4().hex)
+        with open(tmp_path, 'w') as f:
+            f.write(uuid.uuid4().hex)
+        os.replace(tmp_path, self.path)
+
+
+class SiteCache(object):
+    """Keeps the data every page needs (admin, sidebar, unread counter) in memory.
+
+    Each entry is built by a registered loader the first time it is requested and
+    is served from memory until a view calls ``invalidate`` with its key.
+    """
+
+    def __init__(self, app=None):
+        self.loaders = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        stamp_dir = app.config.get('BLUELOG_CACHE_STAMP_DIR') or app.instance_path
+        os.makedirs(stamp_dir, exist_ok=True)
+        app.extensions['site_cache'] = {
+            'lock': threading.Lock(),
+            'entries': {},
+            'stamps': {},
+            'stamp_dir': stamp_dir,
+            'timeout': app.config.get('BLUELOG_SITE_CACHE_TIMEOUT'),
+        }
+
+    def loader(self, key):
+        def decorator(f):
+            self.loaders[key] = f
+            return f
+        return decorator
+
+    def _state(self):
+        return current_app.extensions['site_cache']
+
+    def _stamp(self, key):
+        state = self._state()
+        stamp = state['stamps'].get(key)
+        if stamp is None:
+            stamp = state['stamps'][key] = VersionStamp(os.path.join(state['stamp_dir'], 'site-%s.stamp' % key))
+        return stamp
+
+    def get(self, key):
+        state = self._state()
+        version = self._stamp(key).get()
+        entry = state['entries'].get(key)
+        if entry is not None:
+            value, entry_version, expires = entry
+            if entry_version == version and (expires is None or expires > time.time()):
+                return value
+        with primary_reads():
+            value = self.loaders[key]()
+        expires = time.time() + state['timeout'] if state['timeout'] else None
+        with state['lock']:
+            state['entries'][key] = (value, version, expires)
+        return value
+
+    def version(self, key):
+        return self._stamp(key).get()
+
+    def invalidate(self, *keys):
+        state = self._state()
+        with state['lock']:
+            for key in keys:
+                state['entries'].pop(key, None)
+                self._stamp(key).bump()
+
+
+class LRUBackend(object):
+    """In-process backend, evicts the least recently used entry when full."""
+
+    def __init__(self, max_entries=500):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class FileSystemBackend(object):
+    """Backend shared by every worker process on the host, one pickle file per key.
+
+    Every ``prune_every`` writes the files older than ``max_age`` are deleted,
+    then the oldest ones beyond ``max_entries``.
+    """
+
+    prune_every = 100
+
+    def __init__(self, path, max_entries=500, max_age=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._writes = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._filename(key), 'rb') as f:
+                value, expires = pickle.load(f)
+        except (OSError, EOFError, pickle.PickleError):
+            return None
+        if expires is not None and expires <= time.time():
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout else None
+        filename = self._filename(key)
+        tmp_filename = '%s.%s' % (filename, uuid.uuid4().hex)
+        try:
+            with open(tmp_filename, 'wb') as f:
+                pickle.dump((value, expires), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_filename, filename)
+        except OSError:
+            current_app.logger.exception('Could not write page cache entry')
+        self._writes += 1
+        if self._writes % self.prune_every == 0:
+            self.prune()
+
+    def prune(self):
+        now = time.time()
+        kept = []
+        for entry in os.scandir(self.path):
+            try:
+                mtime = entry.stat().st_mtime
+                if self.max_age and mtime <= now - self.max_age:
+                    os.remove(entry.path)
+                else:
+                    kept.append((mtime, entry.path))
+            except FileNotFoundError:
+                # Another worker pruned it first.
+                continue
+        kept.sort()
+        for mtime, path in kept[:max(len(kept) - self.max_entries, 0)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class ResponseCache(object):
+    """Caches whole responses of public pages for anonymous readers.
+
+    Views label what they show with ``tag`` (``index``, ``post:<id>``,
+    ``category:<id>``, and ``site`` for the sidebar on every page); ``purge``
+    drops every cached page carrying one of the given tags. Each tag has a
+    random version token and an entry is only served while all of its tokens
+    are current, so purging is a single write per tag.
+    """
+
+    csrf_placeholder = '__BLUELOG_CSRF_TOKEN__'
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config.get('BLUELOG_PAGE_CACHE')
+        if backend == 'lru':
+            backend = LRUBackend(app.config['BLUELOG_PAGE_CACHE_SIZE'])
+        elif backend == 'filesystem':
+            backend = FileSystemBackend(app.config['BLUELOG_PAGE_CACHE_DIR'] or
+                                        os.path.join(app.instance_path, 'page-cache'),
+                                        app.config['BLUELOG_PAGE_CACHE_SIZE'], app.config['BLUELOG_PAGE_CACHE_TIMEOUT'])
+        app.extensions['page_cache'] = backend
+
+    @property
+    def backend(self):
+        return current_app.extensions.get('page_cache')
+
+    def tag(self, *tags):
+        g.setdefault('cache_tags', set()).update(tags)
+
+    def purge(self, *tags):
+        backend = self.backend
+        if backend is None:
+            return
+        for tag in tags:
+            backend.set('tag:%s' % tag, uuid.uuid4().hex)
+
+    def _tag_version(self, tag):
+        version = self.backend.get('tag:%s' % tag)
+        if version is None:
+            version = uuid.uuid4().hex
+            self.backend.set('tag:%s' % tag, version)
+        return version
+
+    def _key(self):
+        # Only the page argument is part of the key, see _bypass.
+        return 'page:%s?page=%s|%s' % (request.base_url, request.args.get('page', ''),
+                                       request.cookies.get('theme', ''))
+
+    def _bypass(self):
+        theme = request.cookies.get('theme')
+        # Any other query argument or theme would give each made up value an entry of its own.
+        return (self.backend is None or request.method != 'GET' or current_user.is_authenticated or
+                session.get('_flashes') or current_app.config['BLUELOG_STATIC_EXPORT'] or
+                any(name != 'page' for name in request.args) or
+                (theme is not None and theme not in current_app.config['BLUELOG_THEMES']))
+
+    def cached(self, f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if self._bypass():
+                return f(*args, **kwargs)
+
+            key = self._key()
+            entry = self.backend.get(key)
+            if entry is not None:
+                status, headers, body, tags = entry
+                if all(self._tag_version(tag) == version for tag, version in tags.items()):
+                    if self.csrf_placeholder in body:
+                        body = body.replace(self.csrf_placeholder, generate_csrf())
+                    response = current_app.response_class(body, status=status, headers=headers)
+                    response.headers['X-Cache'] = 'HIT'
+                    return response.make_conditional(request)
+
+            self.tag('site')
+            with primary_reads():
+                response = current_app.make_response(f(*args, **kwargs))
+            if response.status_code != 200 or response.direct_passthrough:
+                return response
+            body = response.get_data(as_text=True)
+            csrf_token = g.get('csrf_token')
+            if csrf_token:
+                body = body.replace(csrf_token, self.csrf_placeholder)
+            headers = [(name, value) for name, value in response.headers if name.lower() != 'set-cookie']
+            tags = dict((tag, self._tag_version(tag)) for tag in g.cache_tags)
+            self.backend.set(key, (response.status_code, headers, body, tags),
+                             current_app.config['BLUELOG_PAGE_CACHE_TIMEOUT'])
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return decorated
+
+
+site_cache = SiteCache()
+page_cache = ResponseCache()
+
+
+@site_cache.loader('admin')
+def load_admin():
+    admin = Admin.query.first()
+    if admin is None:
+        return None
+    return AdminInfo(admin.name, admin.blog_title, admin.blog_subtitle, admin.about)
+
+
+@site_cache.loader('principal')
+def load_principal():
+    admin = Admin.query.first()
+    if admin is None:
+        return None
+    return Principal(admin.id, admin.username, admin.password_hash, admin.name)
+
+
+@site_cache.loader('categories')
+def load_categories():
+    rows = Category.query.with_entities(Category.id, Category.name, Category.post_count).\
+        order_by(Category.name)
+    return [CategoryInfo(*row) for row in rows]
+
+
+@site_cache.loader('archive')
+def load_archive():
+    rows = ArchiveMonth.query.with_entities(ArchiveMonth.year, ArchiveMonth.month, ArchiveMonth.post_count).\
+        filter(ArchiveMonth.post_count > 0).order_by(ArchiveMonth.year.desc(), ArchiveMonth.month.desc())
+    return [MonthInfo(*row) for row in rows]
+
+
+@site_cache.loader('tags')
+def load_tags():
+    """The tag cloud: the most used tags, each with a weight of 1 to 5 from its log scaled count."""
+    rows = Tag.query.with_entities(Tag.id, Tag.name, Tag.post_count).filter(Tag.post_count > 0).\
+        order_by(Tag.post_count.desc(), Tag.name).limit(current_app.config['BLUELOG_TAG_CLOUD_SIZE']).all()
+    if not rows:
+        return []
+    low, high = math.log(rows[-1].post_count), math.log(rows[0].post_count)
+    spread = high - low or 1.0
+    tags = [TagInfo(tag_id, name, post_count, 1 + int(round(4 * (math.log(post_count) - low) / spread)))
+            for tag_id, name, post_count in rows]
+    return sorted(tags, key=lambda tag: tag.name.lower())
+
+
+@site_cache.loader('links')
+def load_links():
+    return [LinkInfo(link.id, link.name, link.url) for link in Link.query.order_by(Link.name)]
+
+
+@site_cache.loader('unread_comments')
+def load_unread_comments():
+    return Comment.query.filter_by(reviewed=False).count()
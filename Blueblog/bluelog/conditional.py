@@ -0,0 +1,54 @@
+import hashlib
+import time
+
+from flask import current_app, request, session
+from flask_login import current_user
+
+from bluelog.caching import site_cache
+
+
+class Validators(object):
+    """ETag and Last-Modified for a public page, computed before it is rendered.
+
+    The ETag covers the given content version parts plus everything every page
+    shows (admin info, sidebar with its archive and tag cloud, theme), so a 304
+    is only sent when nothing visible has changed.
+    """
+
+    def __init__(self, last_modified, *parts):
+        self.last_modified = last_modified
+        self.enabled = request.method == 'GET' and not current_user.is_authenticated and \
+            not session.get('_flashes')
+        if not self.enabled:
+            self.etag = None
+            return
+        site = (site_cache.get('admin'), site_cache.get('categories'), site_cache.get('archive'),
+                site_cache.get('tags'), site_cache.get('links'))
+        key = repr((last_modified, parts, site, request.cookies.get('theme')))
+        self.etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def not_modified(self):
+        if not self.enabled:
+            return None
+        response = current_app.response_class(status=200)
+        self.apply(response)
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+        return None
+
+    def apply(self, response):
+        if not self.enabled:
+            return response
+        response.set_etag(self.etag)
+        if self.last_modified is not None:
+            response.last_modified = self.last_modified
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response
+
+
+def csrf_period():
+    """Changes whenever a CSRF token rendered into a cached page may have expired."""
+    time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+    return int(time.time() // max(time_limit // 2, 1))
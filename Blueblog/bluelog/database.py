@@ -0,0 +1,111 @@
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request, session
+from flask_login import current_user
+from flask_sqlalchemy import SignallingSession, get_state
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.expression import TextClause, UpdateBase
+
+REPLICA = 'replica'
+
+
+def engine_options(config):
+    """``SQLALCHEMY_ENGINE_OPTIONS`` for the configured database.
+
+    Server databases get a sized pool with pre-ping, recycling and a statement
+    timeout; SQLite gets a busy timeout and the ``BLUELOG_SQLITE_PRAGMAS`` run on
+    every new connection. Explicit ``SQLALCHEMY_ENGINE_OPTIONS`` entries win.
+    """
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    backend = url.get_backend_name()
+    options = {}
+    connect_args = {}
+    if backend == 'sqlite':
+        # Flask-SQLAlchemy sets its own connect_args for in-memory databases.
+        if url.database not in (None, '', ':memory:'):
+            connect_args['timeout'] = config['BLUELOG_DB_BUSY_TIMEOUT']
+        options['sqlite_pragmas'] = dict(config['BLUELOG_SQLITE_PRAGMAS'])
+    else:
+        options['pool_pre_ping'] = True
+        for key, option in (('BLUELOG_DB_POOL_SIZE', 'pool_size'), ('BLUELOG_DB_MAX_OVERFLOW', 'max_overflow'),
+                            ('BLUELOG_DB_POOL_RECYCLE', 'pool_recycle'), ('BLUELOG_DB_POOL_TIMEOUT', 'pool_timeout')):
+            if config[key] is not None:
+                options[option] = config[key]
+        timeout = config['BLUELOG_DB_STATEMENT_TIMEOUT']
+        if timeout:
+            if backend == 'postgresql':
+                connect_args['options'] = '-c statement_timeout=%d' % timeout
+            elif backend == 'mysql':
+                connect_args['init_command'] = 'SET SESSION max_execution_time=%d' % timeout
+    if connect_args:
+        options['connect_args'] = connect_args
+    explicit = config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}
+    options.update((key, value) for key, value in explicit.items() if key != 'connect_args')
+    if 'connect_args' in explicit:
+        options['connect_args'] = dict(connect_args, **explicit['connect_args'])
+    return options
+
+
+def apply_sqlite_pragmas(engine, pragmas):
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+
+def _is_read(clause):
+    if clause is None:
+        return True
+    if isinstance(clause, UpdateBase):
+        return False
+    if isinstance(clause, TextClause):
+        return clause.text.lstrip().upper().startswith(('SELECT', 'WITH'))
+    return True
+
+
+class RoutingSession(SignallingSession):
+    """Sends the reads of requests marked by ``init_database`` to the replica bind."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_request_context() and g.get('read_replica') and _is_read(clause):
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+@contextmanager
+def primary_reads():
+    """Send the reads of the block to the primary.
+
+    Caches are filled under the version current on the primary, a lagging
+    replica would store stale data under it until the entry expires.
+    """
+    replica = has_request_context() and g.get('read_replica')
+    if replica:
+        g.read_replica = False
+    try:
+        yield
+    finally:
+        if replica:
+            g.read_replica = True
+
+
+def init_database(app):
+    """Derive the engine options and the replica bind, call it before ``db.init_app``."""
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+    replica_uri = app.config['BLUELOG_REPLICA_DATABASE_URI']
+    if not replica_uri:
+        return
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    binds[REPLICA] = replica_uri
+    app.config['SQLALCHEMY_BINDS'] = binds
+
+    @app.before_request
+    def choose_database():
+        # Readers who just wrote something (a flash is pending) or may write
+        # (the admin) stay on the primary, so they never see replication lag.
+        g.read_replica = request.method in ('GET', 'HEAD') and \
+            request.blueprint in app.config['BLUELOG_REPLICA_BLUEPRINTS'] and \
+            '_flashes' not in session and not current_user.is_authenticated
@@ -1,35 +1,45 @@
-from threading import Thread
-
 from flask import url_for, current_app
-from flask_mail import Message
 
-from bluelog.extensions import mail
+from bluelog.extensions import db
+from bluelog.mailqueue import enqueue_mail, pending_digest
+from bluelog.models import MailMessage
 
 
-def _sen_async_mail(app, message):
-    with app.app_context():
-        mail.send(message)
+def send_mail(subject, to, html, digest_key=None, delay=None, digest_count=1, commit=True):
+    return enqueue_mail(subject, to, html, digest_key=digest_key, delay=delay, digest_count=digest_count,
+                        commit=commit)
 
 
-def send_mail(subject, to, html):
-    app = current_app._get_current_object()
-    message = Message(subject, recipients=[to], html=html)
-    thr = Thread(target=_sen_async_mail, args=[app, message])
-    thr.start()
-    return thr
+def _new_comment_html(post, post_url, count):
+    if count > 1:
+        summary = '<p>%d new comments in post <i>%s</i>, click the link below to check:</p>' % (count, post.title)
+    else:
+        summary = '<p>New comment in post <i>%s</i>, click the link below to check:</p>' % post.title
+    return summary + '<p><a href="%s">%s</a></p>' % (post_url, post_url)
 
 
-def send_new_comment_email(post):
+def send_new_comment_email(post, count=1, commit=True):
+    """Notify the admin of ``count`` new comments, merged into the pending digest of the post."""
     post_url = url_for('blog.show_post', post_id=post.id, _external=True) + '#comments'
-    send_mail(subject='New comment', to=current_app.config['BLUELOG_EMAIL'],
-              html='<p>New comment in post <i>%s</i>, click the link below to check:</p>'
-                   '<p><a href="%s">%s</a></p>'
-                   % (post.title, post_url, post_url))
-
-
-def send_new_reply_email(comment):
+    digest_key = 'new-comment:%d' % post.id
+    message = pending_digest(digest_key)
+    if message is not None:
+        total = message.digest_count + count
+        # Only merge while no worker has claimed the message.
+        merged = MailMessage.query.filter_by(id=message.id, locked_by=None).update(
+            {'digest_count': total, 'html': _new_comment_html(post, post_url, total)}, synchronize_session=False)
+        if commit:
+            db.session.commit()
+        if merged:
+            return message
+    return send_mail(subject='New comment', to=current_app.config['BLUELOG_EMAIL'],
+                     html=_new_comment_html(post, post_url, count), digest_key=digest_key,
+                     delay=current_app.config['BLUELOG_MAIL_DIGEST_WINDOW'], digest_count=count, commit=commit)
+
+
+def send_new_reply_email(comment, commit=True):
     post_url = url_for('blog.show_post', post_id=comment.post_id, _external=True) + '#comments'
     send_mail(subject='New reply', to=comment.email,
               html='<p>New reply for the comment you left in post <i>%s</i>, click the link below to check: </p>'
                    '<p><a href="%s">%s</a></p>'
-                   % (comment.post.title, post_url, post_url))
+                   % (comment.post.title, post_url, post_url), commit=commit)
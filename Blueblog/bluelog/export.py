@@ -0,0 +1,257 @@
+import json
+import math
+import multiprocessing
+import os
+import shutil
+from datetime import datetime
+
+from flask import url_for
+
+from bluelog.caching import site_cache
+from bluelog.extensions import db
+from bluelog.models import ArchiveMonth, Category, Post, Comment, Tag, post_tag
+
+MANIFEST = 'export.json'
+# Bumped when every page renders differently, an incremental export then renders them all.
+FORMAT = 2
+# Data shown on every page, a change to any of it means a full export.
+SITE_KEYS = ('admin', 'categories', 'archive', 'tags', 'links')
+
+_worker = {}
+
+
+def page_path(target, url):
+    """``/post/1`` is written to ``post/1/index.html``, so any static file server can serve it."""
+    return os.path.join(target, url.strip('/'), 'index.html') if url.strip('/') \
+        else os.path.join(target, 'index.html')
+
+
+def _page_arg(page):
+    # The first page has no page segment in its url.
+    return page if page != '1' else None
+
+
+def _pages(url, count):
+    return [url('1')] + [url(str(page)) for page in range(2, count + 1)]
+
+
+def _page_count(total, per_page):
+    return max(int(math.ceil(total / float(per_page))), 1)
+
+
+def _index_urls(config):
+    total = Post.query.count()
+    return _pages(lambda page: url_for('blog.index', page=_page_arg(page)),
+                  _page_count(total, config['BLUELOG_POST_PER_PAGE']))
+
+
+def _category_urls(config, category_id, post_count):
+    return _pages(lambda page: url_for('blog.show_category', category_id=category_id,
+                                       page=_page_arg(page)),
+                  _page_count(post_count, config['BLUELOG_POST_PER_PAGE']))
+
+
+def _month_urls(config, year, month, post_count):
+    return _pages(lambda page: url_for('blog.show_month', year=year, month=month, page=_page_arg(page)),
+                  _page_count(post_count, config['BLUELOG_POST_PER_PAGE']))
+
+
+def _tag_urls(config, tag_id, post_count):
+    return _pages(lambda page: url_for('blog.show_tag', tag_id=tag_id, page=_page_arg(page)),
+                  _page_count(post_count, config['BLUELOG_POST_PER_PAGE']))
+
+
+def _thread_counts(post_ids=None):
+    # Post pages are paginated by top level comments.
+    query = db.session.query(Comment.post_id, db.func.count(Comment.id)).\
+        filter(Comment.reviewed == db.true(), Comment.reply_id.is_(None))
+    if post_ids is not None:
+        query = query.filter(Comment.post_id.in_(post_ids))
+    return dict(query.group_by(Comment.post_id))
+
+
+def _post_urls(config, post_id, comment_count):
+    return _pages(lambda page: url_for('blog.show_post', post_id=post_id, page=_page_arg(page)),
+                  _page_count(comment_count, config['BLUELOG_COMMENT_PER_PAGE']))
+
+
+def _all_urls(config):
+    urls = _index_urls(config) + [url_for('blog.about'), url_for('blog.archive')]
+    for category_id, post_count in db.session.query(Category.id, Category.post_count):
+        urls.extend(_category_urls(config, category_id, post_count))
+    for year, month, post_count in db.session.query(ArchiveMonth.year, ArchiveMonth.month, ArchiveMonth.post_count).\
+            filter(ArchiveMonth.post_count > 0):
+        urls.extend(_month_urls(config, year, month, post_count))
+    for tag_id, post_count in db.session.query(Tag.id, Tag.post_count).filter(Tag.post_count > 0):
+        urls.extend(_tag_urls(config, tag_id, post_count))
+    threads = _thread_counts()
+    for post_id, in db.session.query(Post.id):
+        urls.extend(_post_urls(config, post_id, threads.get(post_id, 0)))
+    return urls
+
+
+def _page_of(query, post, per_page):
+    newer = query.filter(db.or_(Post.timestamp > post.timestamp,
+                                db.and_(Post.timestamp == post.timestamp, Post.id > post.id))).count()
+    return str(newer // per_page + 1)
+
+
+def _changed_urls(config, since):
+    """Pages showing a post modified after ``since``, comment changes bump the post's ``last_modified``."""
+    per_page = config['BLUELOG_POST_PER_PAGE']
+    urls = set()
+    changed = Post.query.filter(Post.last_modified > since).\
+        options(db.load_only('id', 'timestamp', 'category_id')).all()
+    threads = _thread_counts([post.id for post in changed]) if changed else {}
+    tag_ids = {}
+    if changed:
+        for post_id, tag_id in db.session.query(post_tag.c.post_id, post_tag.c.tag_id).\
+                filter(post_tag.c.post_id.in_([post.id for post in changed])):
+            tag_ids.setdefault(post_id, []).append(tag_id)
+    for post in changed:
+        urls.update(_post_urls(config, post.id, threads.get(post.id, 0)))
+        page = _page_of(Post.query, post, per_page)
+        urls.add(url_for('blog.index', page=_page_arg(page)))
+        page = _page_of(Post.query.filter_by(category_id=post.category_id), post, per_page)
+        urls.add(url_for('blog.show_category', category_id=post.category_id, page=_page_arg(page)))
+        start, end = ArchiveMonth.bounds(post.timestamp.year, post.timestamp.month)
+        page = _page_of(Post.query.filter(Post.timestamp >= start, Post.timestamp < end), post, per_page)
+        urls.add(url_for('blog.show_month', year=post.timestamp.year, month=post.timestamp.month,
+                         page=_page_arg(page)))
+        for tag_id in tag_ids.get(post.id, ()):
+            tagged = Post.query.join(post_tag).filter(post_tag.c.tag_id == tag_id)
+            urls.add(url_for('blog.show_tag', tag_id=tag_id, page=_page_arg(_page_of(tagged, post, per_page))))
+    return urls
+
+
+def _init_worker(app, target):
+    with app.app_context():
+        # Connections inherited from the parent process must not be shared.
+        db.engine.dispose()
+    _worker['client'] = app.test_client()
+    _worker['target'] = target
+
+
+def _render(url):
+    response = _worker['client'].get(url)
+    if response.status_code != 200:
+        return url, response.status_code
+    path = page_path(_worker['target'], url)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(response.get_data())
+    os.replace(tmp_path, path)
+    return url, 200
+
+
+def _sync_tree(source, target):
+    """Copy the files of ``source`` that are missing or changed in ``target``."""
+    copied = 0
+    for root, dirs, files in os.walk(source):
+        destination = os.path.join(target, os.path.relpath(root, source))
+        os.makedirs(destination, exist_ok=True)
+        for name in files:
+            source_path, target_path = os.path.join(root, name), os.path.join(destination, name)
+            stat = os.stat(source_path)
+            try:
+                current = os.stat(target_path)
+                if current.st_size == stat.st_size and current.st_mtime >= stat.st_mtime:
+                    continue
+            except FileNotFoundError:
+                pass
+            shutil.copy2(source_path, target_path)
+            copied += 1
+    return copied
+
+
+def load_manifest(target):
+    try:
+        with open(os.path.join(target, MANIFEST)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def export_site(app, target, incremental=False, workers=1, progress=None):
+    """Render the public pages of the blog into ``target`` as static HTML files.
+
+    Pages are requested through the test client as an anonymous reader, so they
+    are exactly what the app serves. With ``incremental`` only the pages of posts
+    changed since the last export are rendered again, unless the data shown on
+    every page (admin, sidebar) changed in between. Post pages are rendered
+    without the comment form, its CSRF token would be bound to the session of
+    the exporting client.
+
+    Returns ``(rendered, removed, failed)``.
+    """
+    target = os.path.abspath(target)
+    os.makedirs(target, exist_ok=True)
+    # Page numbers must map to files, cursor links would not.
+    overrides = dict(BLUELOG_PAGINATION='offset', BLUELOG_PAGINATION_COUNT=True, BLUELOG_STATIC_EXPORT=True)
+    previous = dict((key, app.config.get(key)) for key in overrides)
+    app.config.update(overrides)
+    try:
+        return _export(app, target, incremental, workers, progress)
+    finally:
+        app.config.update(previous)
+
+
+def _export(app, target, incremental, workers, progress):
+    with app.test_request_context():
+        started = datetime.utcnow()
+        versions = dict((key, list(site_cache.version(key) or ())) for key in SITE_KEYS)
+        urls = _all_urls(app.config)
+        manifest = load_manifest(target)
+        exported = set(manifest['pages']) if manifest else set()
+        removed = exported - set(urls)
+        if incremental and manifest is not None and manifest.get('format', 1) == FORMAT and \
+                manifest.get('versions') == versions:
+            since = datetime.strptime(manifest['exported_at'], '%Y-%m-%dT%H:%M:%S.%f')
+            pending = (_changed_urls(app.config, since) | (set(urls) - exported)) & set(urls)
+        else:
+            pending = set(urls)
+
+    for url in removed:
+        try:
+            os.remove(page_path(target, url))
+        except FileNotFoundError:
+            pass
+
+    pending = sorted(pending)
+    failed = []
+    if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        # Forked workers share the app and its configuration without pickling it.
+        pool = multiprocessing.get_context('fork').Pool(workers, _init_worker, (app, target))
+        results = pool.imap_unordered(_render, pending, chunksize=16)
+    else:
+        pool = None
+        _init_worker(app, target)
+        results = map(_render, pending)
+    try:
+        for done, (url, status) in enumerate(results, 1):
+            if status != 200:
+                failed.append((url, status))
+            if progress is not None:
+                progress(done, len(pending))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    _sync_tree(app.static_folder, os.path.join(target, 'static'))
+    if os.path.isdir(app.config['BLUELOG_ASSETS_PATH']):
+        _sync_tree(app.config['BLUELOG_ASSETS_PATH'], os.path.join(target, 'assets'))
+    if os.path.isdir(app.config['BLUELOG_UPLOAD_PATH']):
+        with app.test_request_context():
+            uploads = url_for('admin.get_image', filename='x').rsplit('/', 1)[0]
+        _sync_tree(app.config['BLUELOG_UPLOAD_PATH'], os.path.join(target, uploads.strip('/')))
+
+    failed_urls = set(url for url, status in failed)
+    manifest = dict(format=FORMAT, exported_at=started.strftime('%Y-%m-%dT%H:%M:%S.%f'), versions=versions,
+                    pages=sorted(url for url in urls if url not in failed_urls))
+    tmp_path = os.path.join(target, MANIFEST + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(target, MANIFEST))
+    return len(pending) - len(failed), len(removed), failed
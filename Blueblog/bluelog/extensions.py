@@ -1,10 +1,26 @@
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy
 from flask_moment import Moment
 from flask_bootstrap import Bootstrap
 from flask_ckeditor import CKEditor
 from flask_mail import Mail
 from flask_login import LoginManager
 from flask_wtf import CSRFProtect
+from sqlalchemy import orm
+
+from bluelog.database import RoutingSession, apply_sqlite_pragmas
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop('sqlite_pragmas', None)
+        engine = BaseSQLAlchemy.create_engine(self, sa_url, engine_opts)
+        if pragmas and engine.dialect.name == 'sqlite':
+            apply_sqlite_pragmas(engine, pragmas)
+        return engine
+
 
 db = SQLAlchemy()
 moment = Moment()
@@ -17,9 +33,12 @@ csrf = CSRFProtect()
 
 @login_manager.user_loader
 def load_user(user_id):
-    from bluelog.models import Admin
-    user = Admin.query.get(int(user_id))
-    return user
+    # Served from the site cache, so signed in requests cost no identity query.
+    from bluelog.caching import site_cache
+    principal = site_cache.get('principal')
+    if principal is None or str(principal.id) != user_id:
+        return None
+    return principal
 
 
 login_manager.login_view = 'auth.login'
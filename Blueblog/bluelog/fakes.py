@@ -1,13 +1,18 @@
+import multiprocessing
 import random
+from datetime import datetime, timedelta
 
-from sqlalchemy.exc import IntegrityError
 from faker import Faker
 
-from bluelog.models import Admin, Category, Post, Comment
+from bluelog.models import Admin, ArchiveMonth, Category, Post, Comment, Tag
+from bluelog.rendering import make_excerpt
 from bluelog.extensions import db
 
 fake = Faker()
 
+YEAR_SECONDS = 365 * 24 * 60 * 60
+SEED_ANCHOR = datetime(2024, 1, 1)
+
 
 def fake_admin():
     admin = Admin.query.all()
@@ -25,82 +30,169 @@ def fake_admin():
     db.session.commit()
 
 
-def fake_category(count=10):
+def _chunk_faker(seed, index):
+    # Every chunk gets its own generators, so the output does not depend on
+    # which worker process builds it or in which order.
+    rng = random.Random('%s-%d' % (seed, index))
+    chunk_fake = Faker()
+    chunk_fake.seed_instance(rng.random())
+    return rng, chunk_fake
+
+
+def _anchor(seed):
+    # Timestamps count back from a fixed date for a seeded run, so its rows are the same every time.
+    return SEED_ANCHOR if seed is not None else datetime.utcnow()
+
+
+def _random_time(rng, anchor):
+    return anchor - timedelta(seconds=rng.randrange(YEAR_SECONDS))
+
+
+def _post_rows(task):
+    index, start_id, count, seed, category_ids, anchor = task
+    rng, chunk_fake = _chunk_faker(seed, index)
+    # Faker is slow at long texts, so bodies are assembled from a sentence pool.
+    sentences = [chunk_fake.sentence() for _ in range(200)]
+    rows = []
+    for post_id in range(start_id, start_id + count):
+        timestamp = _random_time(rng, anchor)
+        paragraphs = [' '.join(rng.choice(sentences) for _ in range(rng.randint(4, 8)))
+                      for _ in range(rng.randint(3, 6))]
+        # Generated bodies are plain paragraphs, already safe to serve.
+        body = ''.join('<p>%s</p>' % paragraph for paragraph in paragraphs)
+        rows.append(dict(
+            id=post_id,
+            title=chunk_fake.sentence()[:60],
+            body=body,
+            body_html=body,
+            excerpt=make_excerpt(body),
+            timestamp=timestamp,
+            last_modified=timestamp,
+            category_id=rng.choice(category_ids),
+            can_comment=True
+        ))
+    return rows
+
+
+def _comment_rows(task):
+    index, start_id, count, seed, post_ids, anchor, unreviewed, admin, replies = task
+    rng, chunk_fake = _chunk_faker(seed, index)
+    names = [chunk_fake.name() for _ in range(100)]
+    sentences = [chunk_fake.sentence() for _ in range(200)]
+    rows = []
+    repliable = []  # (id, post id, timestamp) of the reviewed comments of this chunk
+    for comment_id in range(start_id, start_id + count):
+        reply_id = None
+        if repliable and rng.random() < replies:
+            reply_id, post_id, parent_timestamp = rng.choice(repliable)
+            timestamp = parent_timestamp + timedelta(seconds=rng.randrange(1, 7 * 24 * 60 * 60))
+        else:
+            post_id = post_ids[0] + rng.randrange(post_ids[1]) if isinstance(post_ids, tuple) \
+                else rng.choice(post_ids)
+            timestamp = _random_time(rng, anchor)
+        from_admin = rng.random() < admin
+        reviewed = from_admin or rng.random() >= unreviewed
+        name = rng.choice(names)
+        rows.append(dict(
+            id=comment_id,
+            author='Admin' if from_admin else name,
+            email='admin@xxx.com' if from_admin else '%s@example.com' % name.lower().replace(' ', '.'),
+            site='xx.com' if from_admin else 'https://example.com/%d' % rng.randrange(1000),
+            body=rng.choice(sentences),
+            from_admin=from_admin,
+            reviewed=reviewed,
+            timestamp=timestamp,
+            post_id=post_id,
+            reply_id=reply_id
+        ))
+        if reviewed:
+            repliable.append((comment_id, post_id, timestamp))
+    return rows
+
 
-    category = Category(name='Default')
-    db.session.add(category)
+def _tasks(count, chunk_size):
+    for index, start in enumerate(range(0, count, chunk_size)):
+        yield index, start, min(chunk_size, count - start)
 
-    for i in range(count):
-        category = Category(name=fake.word())
-        db.session.add(category)
-        try:
+
+def _bulk_insert(table, make_rows, tasks, workers, progress=None):
+    """Build the rows of each task (in worker processes when ``workers`` > 1) and
+    insert them chunk by chunk, committing after every chunk."""
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        chunks = pool.imap(make_rows, tasks) if pool is not None else map(make_rows, tasks)
+        inserted = 0
+        for rows in chunks:
+            db.session.execute(table.insert(), rows)
             db.session.commit()
-        except IntegrityError:
-            db.session.rollback()
-
-
-def fake_post(count=50):
-    for i in range(count):
-        post = Post(
-            title=fake.sentence(),
-            body=fake.text(2000),
-            category=Category.query.get(random.randint(1, Category.query.count())),
-            timestamp=fake.date_time_this_year()
-        )
-        db.session.add(post)
-    db.session.commit()
+            inserted += len(rows)
+            if progress is not None:
+                progress(inserted)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return inserted
+
 
+def _next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
 
-def fake_comments(count=500):
-    for i in range(count):
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
-
-    salt = int(count * 0.1)
-    for i in range(salt):
-        # unreviewed comments
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=False,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
-        # admin comments
-        comment = Comment(
-            author='Admin',
-            email='admin@xxx.com',
-            site='xx.com',
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            from_admin=True,
-            reviewed=True,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
+
+def fake_category(count=10, seed=None):
+    rng = random.Random(seed)
+    Faker.seed(rng.random())
+    existing = set(name for name, in db.session.query(Category.name))
+    names = []
+    if 'Default' not in existing:
+        existing.add('Default')
+        names.append('Default')
+    target = len(names) + count
+    while len(names) < target:
+        name = fake.word()[:20]
+        if name in existing:
+            name = ('%s-%d' % (name, rng.randrange(1000)))[:20]
+        if name not in existing:
+            existing.add(name)
+            names.append(name)
+    db.session.execute(Category.__table__.insert(), [dict(name=name) for name in names])
     db.session.commit()
-    for i in range(salt):
-        # replies
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,
-            reply=Comment.query.get(random.randint(1, Comment.query.count())),
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
+
+
+def fake_post(count=50, seed=None, workers=1, chunk_size=2000, progress=None):
+    anchor = _anchor(seed)
+    if seed is None:
+        seed = random.randrange(1 << 32)
+    category_ids = [category_id for category_id, in db.session.query(Category.id).order_by(Category.id)]
+    start_id = _next_id(Post)
+    tasks = [(index, start_id + start, size, seed, category_ids, anchor)
+             for index, start, size in _tasks(count, chunk_size)]
+    return _bulk_insert(Post.__table__, _post_rows, tasks, workers, progress)
+
+
+def fake_comments(count=500, seed=None, workers=1, chunk_size=10000, unreviewed=0.1, admin=0.1,
+                  replies=0.1, progress=None):
+    anchor = _anchor(seed)
+    if seed is None:
+        seed = random.randrange(1 << 32)
+    first_id, last_id, post_count = db.session.query(db.func.min(Post.id), db.func.max(Post.id),
+                                                     db.func.count(Post.id)).one()
+    if not post_count:
+        return 0
+    if last_id - first_id + 1 == post_count:
+        post_ids = (first_id, post_count)
+    else:
+        post_ids = [post_id for post_id, in db.session.query(Post.id)]
+    start_id = _next_id(Comment)
+    tasks = [(index, start_id + start, size, seed, post_ids, anchor, unreviewed, admin, replies)
+             for index, start, size in _tasks(count, chunk_size)]
+    return _bulk_insert(Comment.__table__, _comment_rows, tasks, workers, progress)
+
+
+def rebuild_aggregates():
+    """Bring the denormalized data up to date after rows were inserted in bulk."""
+    Category.recount()
+    Post.recount()
+    ArchiveMonth.rebuild()
+    Tag.recount()
     db.session.commit()
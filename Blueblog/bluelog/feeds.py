@@ -0,0 +1,189 @@
+import hashlib
+import os
+import re
+import uuid
+from xml.sax.saxutils import escape, quoteattr
+
+from flask import Response, abort, current_app, request, send_file, stream_with_context, url_for
+
+from bluelog.caching import site_cache
+from bluelog.extensions import db
+from bluelog.loaders import with_profile
+from bluelog.models import Category, Post
+
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+ATOM_NS = 'http://www.w3.org/2005/Atom'
+# Rows turned into XML per chunk written to the client and the cache file.
+STREAM_BATCH = 500
+
+
+def _time(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ') if value is not None else None
+
+
+def _cache_dir():
+    path = current_app.config['BLUELOG_FEED_CACHE_DIR'] or os.path.join(current_app.instance_path, 'feeds')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _tee(chunks, directory, name, filename):
+    """Pass ``chunks`` through while writing them to the cache, which only gets complete files."""
+    tmp_path = os.path.join(directory, '.%s.%s.tmp' % (filename, uuid.uuid4().hex))
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(tmp_path, os.path.join(directory, filename))
+        versions = re.compile(r'^%s-[0-9a-f]{16}\.xml$' % re.escape(name))
+        for stale in os.listdir(directory):
+            if stale != filename and versions.match(stale):
+                os.remove(os.path.join(directory, stale))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def cached_xml(name, version, generate, mimetype='application/xml'):
+    """Serve the XML document ``name`` as generated for ``version``.
+
+    A cached copy is sent straight from the file; otherwise ``generate()`` is
+    streamed to the client and written to the cache at the same time. The ETag
+    is derived from ``version``, so conditional requests never touch the data.
+    """
+    # The documents hold absolute URLs, so each host gets its own copy.
+    etag = hashlib.sha1(repr((name, version, request.host_url)).encode('utf-8')).hexdigest()
+    directory = _cache_dir()
+    filename = '%s-%s.xml' % (name, etag[:16])
+    path = os.path.join(directory, filename)
+    if os.path.exists(path):
+        response = send_file(path, mimetype=mimetype, conditional=True, add_etags=False)
+    else:
+        response = Response(stream_with_context(_tee(generate(), directory, name, filename)), mimetype=mimetype)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def _posts_version():
+    return db.session.query(db.func.max(Post.last_modified), db.func.count(Post.id)).one()
+
+
+def feed_response():
+    admin = site_cache.get('admin')
+    if admin is None:
+        # The blog has not been set up yet.
+        abort(404)
+    limit = current_app.config['BLUELOG_FEED_POST_COUNT']
+    # Entries carry the category names, a rename does not touch the posts.
+    version = (tuple(_posts_version()), admin, site_cache.version('categories'), limit)
+
+    def generate():
+        posts = with_profile(Post.query, 'post_feed').order_by(Post.timestamp.desc(), Post.id.desc()).limit(limit)
+        index_url = url_for('blog.index', _external=True)
+        latest = db.session.query(db.func.max(Post.last_modified)).scalar()
+        yield XML_HEADER
+        yield '<feed xmlns="%s">\n' % ATOM_NS
+        yield '<title>%s</title>\n' % escape(admin.blog_title or '')
+        if admin.blog_subtitle:
+            yield '<subtitle>%s</subtitle>\n' % escape(admin.blog_subtitle)
+        yield '<link href=%s rel="self"/>\n' % quoteattr(url_for('blog.feed', _external=True))
+        yield '<link href=%s/>\n' % quoteattr(index_url)
+        yield '<id>%s</id>\n' % escape(index_url)
+        yield '<updated>%s</updated>\n' % (_time(latest) or '1970-01-01T00:00:00Z')
+        yield '<author><name>%s</name></author>\n' % escape(admin.name or '')
+        for post in posts:
+            post_url = url_for('blog.show_post', post_id=post.id, _external=True)
+            yield ''.join([
+                '<entry>\n',
+                '<title>%s</title>\n' % escape(post.title or ''),
+                '<link href=%s/>\n' % quoteattr(post_url),
+                '<id>%s</id>\n' % escape(post_url),
+                '<published>%s</published>\n' % _time(post.timestamp),
+                '<updated>%s</updated>\n' % _time(post.last_modified or post.timestamp),
+                '<category term=%s/>\n' % quoteattr(post.category.name) if post.category else '',
+                '<summary>%s</summary>\n' % escape(post.excerpt or ''),
+                '<content type="html">%s</content>\n' % escape(post.body_html or ''),
+                '</entry>\n',
+            ])
+        yield '</feed>\n'
+
+    return cached_xml('feed', version, generate, mimetype='application/atom+xml')
+
+
+def _url(location, lastmod=None):
+    if lastmod is None:
+        return '<url><loc>%s</loc></url>\n' % escape(location)
+    return '<url><loc>%s</loc><lastmod>%s</lastmod></url>\n' % (escape(location), _time(lastmod))
+
+
+def _site_urls():
+    latest = db.session.query(db.func.max(Post.last_modified)).scalar()
+    yield _url(url_for('blog.index', _external=True), latest)
+    yield _url(url_for('blog.about', _external=True))
+    updated = dict(db.session.query(Post.category_id, db.func.max(Post.last_modified)).group_by(Post.category_id))
+    for category_id, in db.session.query(Category.id).order_by(Category.id):
+        yield _url(url_for('blog.show_category', category_id=category_id, _external=True), updated.get(category_id))
+
+
+def _post_urls(offset=0, limit=None):
+    query = db.session.query(Post.id, Post.last_modified).order_by(Post.id).offset(offset)
+    if limit is not None:
+        query = query.limit(limit)
+    batch = []
+    for post_id, last_modified in query.yield_per(STREAM_BATCH):
+        batch.append(_url(url_for('blog.show_post', post_id=post_id, _external=True), last_modified))
+        if len(batch) >= STREAM_BATCH:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+
+def _urlset(chunks):
+    yield XML_HEADER
+    yield '<urlset xmlns="%s">\n' % SITEMAP_NS
+    for chunk in chunks:
+        yield chunk
+    yield '</urlset>\n'
+
+
+def _chain(*iterables):
+    for iterable in iterables:
+        for item in iterable:
+            yield item
+
+
+def sitemap_response(part=None):
+    """The whole sitemap, or with more posts than one sitemap may list, an index of parts.
+
+    Part 0 lists the index, about and category pages, the others the posts in
+    chunks of ``BLUELOG_SITEMAP_URLS``.
+    """
+    per_part = current_app.config['BLUELOG_SITEMAP_URLS']
+    last_modified, post_count = _posts_version()
+    version = (last_modified, post_count, site_cache.version('categories'), per_part)
+    parts = int((post_count + per_part - 1) // per_part)
+    split = post_count + Category.query.count() + 2 > per_part
+
+    if part is None and not split:
+        return cached_xml('sitemap', version, lambda: _urlset(_chain(_site_urls(), _post_urls())))
+    if part is None:
+        def generate():
+            yield XML_HEADER
+            yield '<sitemapindex xmlns="%s">\n' % SITEMAP_NS
+            for number in range(parts + 1):
+                yield '<sitemap><loc>%s</loc></sitemap>\n' % escape(
+                    url_for('blog.sitemap_part', part=number, _external=True))
+            yield '</sitemapindex>\n'
+
+        return cached_xml('sitemap', version, generate)
+    if not split or part > parts:
+        abort(404)
+    if part == 0:
+        return cached_xml('sitemap-site', version, lambda: _urlset(_site_urls()))
+    return cached_xml('sitemap-%d' % part, version,
+                      lambda: _urlset(_post_urls((part - 1) * per_part, per_part)))
@@ -17,6 +17,7 @@ class LoginForm(FlaskForm):
 class PostForm(FlaskForm):
     title = StringField('Title', validators=[DataRequired(), Length(1, 60)])
     category = SelectField('Category', coerce=int, default=1)
+    tags = StringField('Tags', description='Separated by commas', validators=[Optional(), Length(0, 200)])
     body = CKEditorField('Body', validators=[DataRequired()])
     submit = SubmitField()
 
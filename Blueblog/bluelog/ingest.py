@@ -0,0 +1,270 @@
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime
+
+from flask import current_app, request
+
+from bluelog.caching import site_cache, page_cache
+from bluelog.emails import send_new_comment_email, send_new_reply_email
+from bluelog.extensions import db
+from bluelog.mailqueue import notify_workers
+from bluelog.models import Post, Comment
+from bluelog.search import index_comments
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+CLAIMED = '.claimed'
+_lock = threading.Lock()
+
+
+class MemoryBuffer(object):
+    """Per process buffer, comments still in it are lost if the process is killed."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        with self._lock:
+            if len(self._items) >= self.max_size:
+                return False
+            self._items.append(item)
+            return True
+
+    def take(self, limit):
+        with self._lock:
+            return [(None, self._items.popleft()) for _ in range(min(limit, len(self._items)))]
+
+    def done(self, batch):
+        pass
+
+    def restore(self, batch):
+        with self._lock:
+            self._items.extendleft(item for token, item in reversed(batch))
+
+
+class SpoolBuffer(object):
+    """One JSON file per comment, survives restarts and is shared by every worker on a host."""
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def _pending(self):
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.json'))
+
+    def __len__(self):
+        return len(self._pending())
+
+    def put(self, item):
+        if len(self) >= self.max_size:
+            return False
+        # Names sort by arrival, so comments are written in the order they came in.
+        name = '%020d-%s.json' % (time.time_ns(), uuid.uuid4().hex)
+        tmp_path = os.path.join(self.path, '.%s.tmp' % name)
+        with open(tmp_path, 'w') as f:
+            json.dump(item, f)
+        os.replace(tmp_path, os.path.join(self.path, name))
+        return True
+
+    def take(self, limit):
+        batch = []
+        for name in self._pending()[:limit]:
+            claimed = os.path.join(self.path, name + CLAIMED)
+            try:
+                # Renaming is atomic, so each file is claimed by one flusher only.
+                os.rename(os.path.join(self.path, name), claimed)
+            except FileNotFoundError:
+                continue
+            os.utime(claimed)
+            with open(claimed) as f:
+                batch.append((claimed, json.load(f)))
+        return batch
+
+    def done(self, batch):
+        for claimed, item in batch:
+            os.remove(claimed)
+
+    def restore(self, batch):
+        for claimed, item in batch:
+            os.replace(claimed, claimed[:-len(CLAIMED)])
+
+    def release_stale(self, max_age=5 * 60):
+        """Give back the claims of flushers that died, returns how many were released."""
+        released = 0
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if name.endswith(CLAIMED) and os.stat(path).st_mtime < time.time() - max_age:
+                os.replace(path, path[:-len(CLAIMED)])
+                released += 1
+        return released
+
+
+def _state(app):
+    state = app.extensions.setdefault('comment_ingest', {})
+    if 'buffer' not in state:
+        with _lock:
+            if 'buffer' not in state:
+                size = app.config['BLUELOG_COMMENT_BUFFER_SIZE']
+                if app.config['BLUELOG_COMMENT_BUFFER'] == 'disk':
+                    buffer = SpoolBuffer(app.config['BLUELOG_COMMENT_SPOOL_DIR'] or
+                                         os.path.join(app.instance_path, 'comment-spool'), size)
+                else:
+                    buffer = MemoryBuffer(size)
+                state.update(buffer=buffer, wakeup=threading.Event())
+    return state
+
+
+def comment_buffer(app=None):
+    return _state(app or current_app._get_current_object())['buffer']
+
+
+def submit_comment(**fields):
+    """Buffer a validated comment for the background writer.
+
+    Returns ``False`` when the buffer is full, the caller then writes the
+    comment itself, so a burst slows down instead of losing comments.
+    """
+    app = current_app._get_current_object()
+    state = _state(app)
+    item = dict(fields, timestamp=datetime.utcnow().strftime(TIME_FORMAT), base_url=request.host_url)
+    if not state['buffer'].put(item):
+        return False
+    _start_flusher(app, state)
+    if len(state['buffer']) >= app.config['BLUELOG_COMMENT_BATCH_SIZE']:
+        state['wakeup'].set()
+    return True
+
+
+def _insert(items):
+    post_ids = set(item['post_id'] for item in items)
+    existing = set(post_id for post_id, in db.session.query(Post.id).filter(Post.id.in_(post_ids)))
+    reply_ids = set(item['reply_id'] for item in items if item['reply_id'])
+    replied = dict((comment.id, comment) for comment in Comment.query.filter(Comment.id.in_(reply_ids))) \
+        if reply_ids else {}
+    written = []
+    for item in items:
+        # The post may have been deleted while the comment waited.
+        if item['post_id'] not in existing:
+            continue
+        comment = Comment(post_id=item['post_id'], author=item['author'], email=item['email'], site=item['site'],
+                          body=item['body'], from_admin=item['from_admin'], reviewed=item['reviewed'],
+                          timestamp=datetime.strptime(item['timestamp'], TIME_FORMAT),
+                          reply=replied.get(item['reply_id']))
+        db.session.add(comment)
+        written.append((comment, item))
+    db.session.flush()
+    index_comments([comment.id for comment, item in written if comment.reviewed])
+    return written
+
+
+def _notify(written):
+    if any(not comment.reviewed for comment, item in written):
+        site_cache.invalidate('unread_comments')
+    purged = set('post:%d' % comment.post_id for comment, item in written if comment.reviewed)
+    if purged:
+        page_cache.purge(*purged)
+
+    # One digest update per post and one mail per replied comment, all in one transaction.
+    unread, replied = OrderedDict(), OrderedDict()
+    for comment, item in written:
+        if not comment.reviewed:
+            count, base_url = unread.get(comment.post_id, (0, item['base_url']))
+            unread[comment.post_id] = (count + 1, base_url)
+        if comment.reply is not None:
+            replied.setdefault(comment.reply.id, (comment.reply, item['base_url']))
+    if not unread and not replied:
+        return
+    posts = dict((post.id, post) for post in Post.query.filter(Post.id.in_(list(unread)))) if unread else {}
+    app = current_app._get_current_object()
+    # The emails link back to the host the comment was posted to.
+    for post_id, (count, base_url) in unread.items():
+        with app.test_request_context(base_url=base_url):
+            send_new_comment_email(posts[post_id], count=count, commit=False)
+    for reply, base_url in replied.values():
+        with app.test_request_context(base_url=base_url):
+            send_new_reply_email(reply, commit=False)
+    db.session.commit()
+    notify_workers()
+
+
+def flush(buffer=None, batch_size=None):
+    """Write one batch of buffered comments in a single transaction, returns how many were taken.
+
+    Notifications and cache purges only happen after the commit; a failed
+    batch is put back into the buffer.
+    """
+    buffer = buffer or comment_buffer()
+    batch = buffer.take(batch_size or current_app.config['BLUELOG_COMMENT_BATCH_SIZE'])
+    if not batch:
+        return 0
+    try:
+        written = _insert([item for token, item in batch])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        buffer.restore(batch)
+        raise
+    buffer.done(batch)
+    _notify(written)
+    return len(batch)
+
+
+def drain(buffer=None):
+    taken = 0
+    while True:
+        count = flush(buffer)
+        if not count:
+            return taken
+        taken += count
+
+
+def _work(app, state, stop):
+    with app.app_context():
+        while True:
+            state['wakeup'].wait(app.config['BLUELOG_COMMENT_FLUSH_INTERVAL'])
+            state['wakeup'].clear()
+            stopping = stop.is_set()
+            try:
+                drain(state['buffer'])
+            except Exception:
+                app.logger.exception('Could not write buffered comments')
+            finally:
+                db.session.remove()
+            if stopping:
+                return
+
+
+def _start_flusher(app, state):
+    if 'thread' in state:
+        return
+    with _lock:
+        if 'thread' in state:
+            return
+        stop = threading.Event()
+        thread = threading.Thread(target=_work, args=[app, state, stop], name='bluelog-comments')
+        thread.daemon = True
+        thread.start()
+        state.update(thread=thread, stop=stop)
+    atexit.register(stop_flusher, app)
+
+
+def stop_flusher(app, timeout=30):
+    """Write what is left in the buffer and stop the background writer."""
+    state = app.extensions.get('comment_ingest', {})
+    with _lock:
+        thread, stop = state.pop('thread', None), state.pop('stop', None)
+    if thread is None:
+        return
+    stop.set()
+    state['wakeup'].set()
+    thread.join(timeout)
@@ -0,0 +1,148 @@
+import cProfile
+import io
+import json
+import logging
+import pstats
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+
+from flask import current_app, g, request, has_request_context, signals_available, before_render_template, \
+    template_rendered
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('bluelog.profile')
+
+_listening = False
+_listen_lock = threading.Lock()
+
+_literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_in_list_re = re.compile(r'IN \((?:\?|%\(\w+\)s|:\w+)(?:, (?:\?|%\(\w+\)s|:\w+))*\)')
+_space_re = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """Reduce a statement to its shape, so that the same query with other values compares equal."""
+    shape = _space_re.sub(' ', statement).strip()
+    shape = _literal_re.sub('?', shape)
+    return _in_list_re.sub('IN (?)', shape)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('bluelog_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['bluelog_query_start'].pop()
+    if has_request_context():
+        profile = g.get('bluelog_profile')
+        if profile is not None:
+            profile['queries'].append((statement, (time.perf_counter() - start) * 1000))
+
+
+def _before_render_template(app, template, context, **extra):
+    profile = g.get('bluelog_profile')
+    if profile is not None:
+        profile['render_started'].append(time.perf_counter())
+
+
+def _template_rendered(app, template, context, **extra):
+    profile = g.get('bluelog_profile')
+    if profile is not None and profile['render_started']:
+        profile['render_ms'] += (time.perf_counter() - profile['render_started'].pop()) * 1000
+
+
+class Profiler(object):
+    """Records SQL statements, template render time and optional cProfile stats per request.
+
+    Each request ends up in a structured log line, a ``Server-Timing`` header and
+    the history shown on the admin profiling page.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        global _listening
+        app.extensions['profiler'] = deque(maxlen=app.config['BLUELOG_PROFILE_HISTORY'])
+        if not app.config['BLUELOG_PROFILING']:
+            return
+        with _listen_lock:
+            if not _listening:
+                event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+                event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+                if signals_available:
+                    before_render_template.connect(_before_render_template)
+                    template_rendered.connect(_template_rendered)
+                _listening = True
+        app.before_request(self._start)
+        app.after_request(self._finish)
+
+    def history(self, app):
+        return list(reversed(app.extensions['profiler']))
+
+    def _start(self):
+        g.bluelog_profile = dict(started=time.perf_counter(), queries=[], render_started=[], render_ms=0.0,
+                                 profiler=None)
+        if random.random() < current_app.config['BLUELOG_PROFILE_SAMPLE_RATE']:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            g.bluelog_profile['profiler'] = profiler
+
+    def _finish(self, response):
+        profile = g.pop('bluelog_profile', None)
+        if profile is None:
+            return response
+        total_ms = (time.perf_counter() - profile['started']) * 1000
+        stats = None
+        if profile['profiler'] is not None:
+            profile['profiler'].disable()
+            stream = io.StringIO()
+            pstats.Stats(profile['profiler'], stream=stream).sort_stats('cumulative').print_stats(30)
+            stats = stream.getvalue()
+
+        config = current_app.config
+        queries = profile['queries']
+        db_ms = sum(duration for statement, duration in queries)
+        slow_queries = [dict(statement=statement, ms=round(duration, 2)) for statement, duration in queries
+                        if duration >= config['BLUELOG_SLOW_QUERY_MS']]
+        shapes = Counter(statement_shape(statement) for statement, duration in queries)
+        repeated = [dict(statement=shape, count=count) for shape, count in shapes.most_common()
+                    if count >= config['BLUELOG_N_PLUS_ONE_THRESHOLD']]
+
+        record = dict(
+            time=datetime.utcnow().isoformat(),
+            method=request.method,
+            path=request.full_path.rstrip('?'),
+            endpoint=request.endpoint,
+            status=response.status_code,
+            total_ms=round(total_ms, 2),
+            db_ms=round(db_ms, 2),
+            queries=len(queries),
+            render_ms=round(profile['render_ms'], 2),
+            slow_queries=slow_queries,
+            n_plus_one=repeated,
+        )
+        level = logging.WARNING if slow_queries or repeated else logging.INFO
+        logger.log(level, json.dumps(record))
+        record['profile'] = stats
+        current_app.extensions['profiler'].append(record)
+
+        server_timing = config['BLUELOG_SERVER_TIMING']
+        if server_timing == 'admin':
+            # Query counts and timings tell outsiders too much about the site.
+            server_timing = current_user.is_authenticated
+        if server_timing:
+            response.headers.add('Server-Timing', 'db;dur=%.2f;desc="%d queries"' % (db_ms, len(queries)))
+            response.headers.add('Server-Timing', 'render;dur=%.2f' % profile['render_ms'])
+            response.headers.add('Server-Timing', 'app;dur=%.2f' % total_ms)
+        return response
+
+
+profiler = Profiler()
@@ -0,0 +1,37 @@
+from sqlalchemy.orm import defer, joinedload, selectinload, undefer
+
+from bluelog.models import Post, Comment
+
+# Loader options for each list page, so that a page renders with a fixed
+# number of queries no matter how many rows it shows.
+loader_profiles = {
+    'post_list': lambda: [
+        joinedload(Post.category).load_only('id', 'name'),
+        # One IN query for the tags of the whole page.
+        selectinload(Post.tags).load_only('id', 'name'),
+        defer(Post.body),
+        defer(Post.body_html),
+    ],
+    'post_page': lambda: [
+        selectinload(Post.tags).load_only('id', 'name'),
+        defer(Post.body),
+    ],
+    'post_feed': lambda: [
+        joinedload(Post.category).load_only('id', 'name'),
+        defer(Post.body),
+    ],
+    'post_manage': lambda: [
+        joinedload(Post.category).load_only('id', 'name'),
+        defer(Post.body),
+        defer(Post.body_html),
+        defer(Post.excerpt),
+        undefer(Post.body_length),
+    ],
+    'comment_manage': lambda: [
+        joinedload(Comment.post).load_only('id', 'title'),
+    ],
+}
+
+
+def with_profile(query, name):
+    return query.options(*loader_profiles[name]())
@@ -0,0 +1,144 @@
+import smtplib
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from flask import current_app
+from flask_mail import Message
+from sqlalchemy import or_
+
+from bluelog.extensions import db, mail
+from bluelog.models import MailMessage
+
+_wakeup = threading.Event()
+_pool_lock = threading.Lock()
+_pool = []
+
+
+def enqueue_mail(subject, to, html, digest_key=None, delay=None, digest_count=1, commit=True):
+    """Queue a message, without ``commit`` the caller commits and calls ``notify_workers``."""
+    message = MailMessage(subject=subject, recipient=to, html=html, digest_key=digest_key, digest_count=digest_count)
+    if delay:
+        message.next_attempt = datetime.utcnow() + timedelta(seconds=delay)
+    db.session.add(message)
+    if commit:
+        db.session.commit()
+        notify_workers()
+    return message
+
+
+def pending_digest(digest_key):
+    """The queued message that a new notification with ``digest_key`` can be merged into."""
+    return MailMessage.query.filter_by(digest_key=digest_key, locked_by=None, attempts=0, failed=False).\
+        order_by(MailMessage.id.desc()).first()
+
+
+def claim_batch(size):
+    now = datetime.utcnow()
+    due = MailMessage.query.filter(MailMessage.failed == db.false(), MailMessage.next_attempt <= now,
+                                   or_(MailMessage.locked_until.is_(None), MailMessage.locked_until < now))
+    ids = [message_id for message_id, in
+           due.with_entities(MailMessage.id).order_by(MailMessage.next_attempt).limit(size)]
+    if not ids:
+        return []
+    token = uuid.uuid4().hex
+    lease = timedelta(seconds=current_app.config['BLUELOG_MAIL_LEASE'])
+    due.filter(MailMessage.id.in_(ids)).update({'locked_by': token, 'locked_until': now + lease},
+                                               synchronize_session=False)
+    db.session.commit()
+    return MailMessage.query.filter_by(locked_by=token).order_by(MailMessage.id).all()
+
+
+def _reschedule(message, error):
+    message.attempts += 1
+    message.last_error = str(error)
+    message.locked_by = None
+    message.locked_until = None
+    if message.attempts >= current_app.config['BLUELOG_MAIL_MAX_ATTEMPTS']:
+        message.failed = True
+        current_app.logger.error('Giving up on mail %d to %s: %s', message.id, message.recipient, error)
+    else:
+        backoff = current_app.config['BLUELOG_MAIL_RETRY_DELAY'] * 2 ** (message.attempts - 1)
+        message.next_attempt = datetime.utcnow() + timedelta(seconds=min(backoff, 60 * 60))
+
+
+def deliver_batch(connection, batch):
+    """Send ``batch`` over an open SMTP connection, returns the number of messages sent.
+
+    Raises ``SMTPServerDisconnected`` after rescheduling the unsent messages when
+    the connection drops, so that the caller can reconnect.
+    """
+    sent = 0
+    for index, message in enumerate(batch):
+        try:
+            connection.send(Message(message.subject, recipients=[message.recipient], html=message.html))
+        except smtplib.SMTPServerDisconnected as e:
+            for unsent in batch[index:]:
+                _reschedule(unsent, e)
+            db.session.commit()
+            raise
+        except Exception as e:
+            _reschedule(message, e)
+        else:
+            db.session.delete(message)
+            sent += 1
+        db.session.commit()
+    return sent
+
+
+def drain(batch_size=None, stop=None):
+    """Deliver due messages until the queue is empty, reusing one SMTP connection."""
+    batch_size = batch_size or current_app.config['BLUELOG_MAIL_BATCH_SIZE']
+    sent = 0
+    batch = claim_batch(batch_size)
+    while batch and not (stop is not None and stop.is_set()):
+        try:
+            with mail.connect() as connection:
+                while batch:
+                    sent += deliver_batch(connection, batch)
+                    if stop is not None and stop.is_set():
+                        break
+                    batch = claim_batch(batch_size)
+        except smtplib.SMTPServerDisconnected:
+            batch = claim_batch(batch_size)
+        except Exception as e:
+            current_app.logger.exception('Could not connect to the mail server')
+            for message in batch:
+                _reschedule(message, e)
+            db.session.commit()
+            break
+    return sent
+
+
+def _work(app, stop):
+    with app.app_context():
+        while not stop.is_set():
+            try:
+                drain(stop=stop)
+            except Exception:
+                app.logger.exception('Mail worker failed')
+            finally:
+                db.session.remove()
+            _wakeup.wait(app.config['BLUELOG_MAIL_POLL_INTERVAL'])
+            _wakeup.clear()
+
+
+def start_workers(app, count, daemon=True):
+    stop = threading.Event()
+    threads = []
+    for i in range(count):
+        thread = threading.Thread(target=_work, args=[app, stop], name='bluelog-mail-%d' % i)
+        thread.daemon = daemon
+        thread.start()
+        threads.append(thread)
+    return stop, threads
+
+
+def notify_workers():
+    """Wake the workers, starting the in-process pool on first use when it is enabled."""
+    count = current_app.config['BLUELOG_MAIL_WORKERS']
+    if count and not _pool:
+        with _pool_lock:
+            if not _pool:
+                _pool.append(start_workers(current_app._get_current_object(), count))
+    _wakeup.set()
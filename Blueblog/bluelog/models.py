@@ -1,9 +1,14 @@
 from datetime import datetime
 
 from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm.attributes import flag_modified, set_committed_value
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from bluelog.extensions import db
+from bluelog.pagination import paginate
+from bluelog.rendering import sanitize_html, make_excerpt
 
 
 class Admin(db.Model, UserMixin):
@@ -25,21 +30,161 @@ class Admin(db.Model, UserMixin):
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20), unique=True)
+    post_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     posts = db.relationship('Post', back_populates='category')
 
+    @staticmethod
+    def recount():
+        post = Post.__table__
+        category = Category.__table__
+        db.session.execute(category.update().values(
+            post_count=db.select([db.func.count(post.c.id)]).
+            where(post.c.category_id == category.c.id).as_scalar()))
+
+    def delete(self):
+        """Move the posts to the default category, then delete this one."""
+        post = Post.__table__
+        category = Category.__table__
+        # last_modified is bumped by its onupdate, so exports render the moved posts again.
+        moved = db.session.execute(post.update().where(post.c.category_id == self.id).values(category_id=1)).rowcount
+        db.session.execute(category.update().where(category.c.id == 1).
+                           values(post_count=category.c.post_count + moved))
+        # The collection must not be flushed with the posts it held before the move.
+        db.session.expire(self, ['posts'])
+        db.session.delete(self)
+
+
+post_tag = db.Table(
+    'post_tag',
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
+    # The primary key serves the lookups by post, this one the tag pages.
+    db.Index('ix_post_tag_tag', 'tag_id', 'post_id'),
+)
+
+
+class Tag(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(30), unique=True)
+    post_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+
+    @staticmethod
+    def change_counts(tag_ids, delta):
+        if not tag_ids:
+            return
+        tag = Tag.__table__
+        db.session.execute(tag.update().where(tag.c.id.in_(tag_ids)).values(post_count=tag.c.post_count + delta))
+
+    @staticmethod
+    def recount():
+        tag = Tag.__table__
+        db.session.execute(tag.update().values(
+            post_count=db.select([db.func.count()]).where(post_tag.c.tag_id == tag.c.id).as_scalar()))
+
 
 class Post(db.Model):
+    __table_args__ = (
+        db.Index('ix_post_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_post_category_timestamp', 'category_id', 'timestamp', 'id'),
+        db.Index('ix_post_last_modified', 'last_modified'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(60))
     body = db.Column(db.Text)
+    body_length = db.column_property(db.func.length(body), deferred=True)
+    body_html = db.Column(db.Text)
+    excerpt = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    last_modified = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
-    category = db.relationship('Category', back_populates='posts')
+    category = db.relationship('Category', back_populates='posts', active_history=True)
     comments = db.relationship('Comment', back_populates='post', cascade='all')
+    tags = db.relationship('Tag', secondary=post_tag, order_by=Tag.name)
     can_comment = db.Column(db.Boolean, default=True)
+    comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    reviewed_comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+
+    def comment_threads(self, per_page, page=None):
+        """A page of reviewed top level comments, each with its tree of reviewed replies loaded."""
+        pagination = paginate(Comment.query.with_parent(self).filter_by(reviewed=True, reply_id=None),
+                              Comment, per_page, page)
+        Comment.load_threads(pagination.items)
+        return pagination
+
+    def set_tags(self, names):
+        """Tag the post with ``names``, creating the missing tags, returns the ids of the tags added or removed.
+
+        The post counts of those tags are adjusted in place, so the post must be in the session.
+        """
+        names = list(dict.fromkeys(name.strip()[:30] for name in names if name.strip()))
+        tags = Tag.query.filter(Tag.name.in_(names)).all() if names else []
+        known = set(tag.name for tag in tags)
+        tags.extend(Tag(name=name) for name in names if name not in known)
+        persistent = db.inspect(self).persistent
+        old, new = set(self.tags), set(tags)
+        self.tags = tags
+        db.session.flush()
+        added = [tag.id for tag in new - old]
+        removed = [tag.id for tag in old - new]
+        Tag.change_counts(added, 1)
+        Tag.change_counts(removed, -1)
+        if persistent and (added or removed):
+            # The row itself is unchanged, bump it so cached pages of the post go stale.
+            self.last_modified = datetime.utcnow()
+        return set(added + removed)
+
+    def render_body(self):
+        self.body_html = sanitize_html(self.body)
+        self.excerpt = make_excerpt(self.body)
+
+    @staticmethod
+    def render_bodies(missing_only=True, batch_size=500):
+        """Render the stored HTML in batches. Filling in missing HTML keeps ``last_modified``."""
+        query = Post.query.options(load_only('id', 'body', 'last_modified')).order_by(Post.id)
+        if missing_only:
+            query = query.filter(Post.body_html.is_(None))
+        rendered = last_id = 0
+        while True:
+            posts = query.filter(Post.id > last_id).limit(batch_size).all()
+            if not posts:
+                return rendered
+            for post in posts:
+                post.render_body()
+                if missing_only:
+                    # Written back as it is, so the column's onupdate does not fire.
+                    flag_modified(post, 'last_modified')
+            last_id = posts[-1].id
+            rendered += len(posts)
+            db.session.commit()
+
+    @staticmethod
+    def recount(post_ids=None, touch=False):
+        """Recount the comments, ``touch`` marks the posts modified for the callers that changed comments."""
+        post = Post.__table__
+        comment = Comment.__table__
+        statement = post.update().values(
+            comment_count=db.select([db.func.count(comment.c.id)]).
+            where(comment.c.post_id == post.c.id).as_scalar(),
+            reviewed_comment_count=db.select([db.func.count(comment.c.id)]).
+            where(db.and_(comment.c.post_id == post.c.id, comment.c.reviewed == db.true())).as_scalar())
+        if not touch:
+            statement = statement.values(last_modified=post.c.last_modified)
+        if post_ids is not None:
+            statement = statement.where(post.c.id.in_(post_ids))
+        db.session.execute(statement)
 
 
 class Comment(db.Model):
+    __table_args__ = (
+        db.Index('ix_comment_post_timestamp', 'post_id', 'timestamp', 'id'),
+        db.Index('ix_comment_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_comment_reply', 'reply_id'),
+        # Partial on SQLite and PostgreSQL, a plain composite index elsewhere.
+        db.Index('ix_comment_unreviewed', 'reviewed', 'timestamp',
+                 sqlite_where=db.text('reviewed = 0'), postgresql_where=db.text('NOT reviewed')),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     author = db.Column(db.String(50))
     email = db.Column(db.String(254))
@@ -54,8 +199,185 @@ class Comment(db.Model):
     reply = db.relationship('Comment', back_populates='replies', remote_side=[id])
     replies = db.relationship('Comment', back_populates='reply', cascade='all')
 
+    @staticmethod
+    def _descendants(comment_ids, reviewed_only=False):
+        """A recursive CTE of the ids of every reply below ``comment_ids``."""
+        comment = Comment.__table__
+        children = db.select([comment.c.id]).where(comment.c.reply_id.in_(comment_ids))
+        if reviewed_only:
+            children = children.where(comment.c.reviewed == db.true())
+        tree = children.cte('comment_tree', recursive=True)
+        descendants = db.select([comment.c.id]).where(comment.c.reply_id == tree.c.id)
+        if reviewed_only:
+            descendants = descendants.where(comment.c.reviewed == db.true())
+        return tree.union_all(descendants)
+
+    @staticmethod
+    def thread_ids(comment_ids):
+        """``comment_ids`` and the ids of all their replies, at any depth."""
+        comment_ids = list(comment_ids)
+        if not comment_ids:
+            return []
+        tree = Comment._descendants(comment_ids)
+        return comment_ids + [comment_id for comment_id, in db.session.query(tree.c.id)]
+
+    @staticmethod
+    def load_threads(roots):
+        """Load the reviewed replies below ``roots`` in one query and attach them as ``replies``."""
+        if not roots:
+            return roots
+        tree = Comment._descendants([root.id for root in roots], reviewed_only=True)
+        descendants = Comment.query.filter(Comment.id.in_(db.select([tree.c.id]))).\
+            order_by(Comment.timestamp, Comment.id).all()
+        by_id = dict((comment.id, comment) for comment in roots)
+        by_id.update((comment.id, comment) for comment in descendants)
+        children = dict((comment_id, []) for comment_id in by_id)
+        for comment in descendants:
+            children[comment.reply_id].append(comment)
+            set_committed_value(comment, 'reply', by_id[comment.reply_id])
+        for comment_id, replies in children.items():
+            set_committed_value(by_id[comment_id], 'replies', replies)
+        return roots
+
 
 class Link(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30))
     url = db.Column(db.String(255))
+
+
+class MailMessage(db.Model):
+    __table_args__ = (
+        db.Index('ix_mail_message_due', 'failed', 'next_attempt'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(100))
+    recipient = db.Column(db.String(254))
+    html = db.Column(db.Text)
+    digest_key = db.Column(db.String(100), index=True)
+    digest_count = db.Column(db.Integer, default=1)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    next_attempt = db.Column(db.DateTime, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, default=0)
+    locked_by = db.Column(db.String(32), index=True)
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    failed = db.Column(db.Boolean, default=False)
+
+
+class ArchiveMonth(db.Model):
+    """Posts per calendar month, kept current by the ``Post`` mapper events."""
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    month = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    post_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+
+    @staticmethod
+    def bounds(year, month):
+        """The ``[start, end)`` timestamps of a month, for a range scan of the post timestamp index."""
+        start = datetime(year, month, 1)
+        return start, datetime(year + month // 12, month % 12 + 1, 1)
+
+    @staticmethod
+    def rebuild():
+        archive = ArchiveMonth.__table__
+        post = Post.__table__
+        year = db.extract('year', post.c.timestamp)
+        month = db.extract('month', post.c.timestamp)
+        db.session.execute(archive.delete())
+        db.session.execute(archive.insert().from_select(
+            ['year', 'month', 'post_count'],
+            db.select([year, month, db.func.count(post.c.id)]).
+            where(post.c.timestamp.isnot(None)).group_by(year, month)))
+
+
+class SearchEntry(db.Model):
+    __table_args__ = (
+        db.Index('ix_search_entry_document', 'doc_type', 'doc_id'),
+    )
+
+    term = db.Column(db.String(64), primary_key=True)
+    doc_type = db.Column(db.String(10), primary_key=True)
+    doc_id = db.Column(db.Integer, primary_key=True)
+    weight = db.Column(db.Integer, default=1)
+
+
+def _change_post_count(connection, category_id, delta):
+    if category_id is None:
+        return
+    category = Category.__table__
+    connection.execute(category.update().where(category.c.id == category_id).
+                       values(post_count=category.c.post_count + delta))
+
+
+def _change_month_count(connection, timestamp, delta):
+    if timestamp is None:
+        return
+    archive = ArchiveMonth.__table__
+    result = connection.execute(archive.update().
+                                where(db.and_(archive.c.year == timestamp.year, archive.c.month == timestamp.month)).
+                                values(post_count=archive.c.post_count + delta))
+    if not result.rowcount and delta > 0:
+        connection.execute(archive.insert().values(year=timestamp.year, month=timestamp.month, post_count=delta))
+
+
+def _change_comment_count(connection, post_id, delta, reviewed_delta):
+    if post_id is None:
+        return
+    post = Post.__table__
+    connection.execute(post.update().where(post.c.id == post_id).
+                       values(comment_count=post.c.comment_count + delta,
+                              reviewed_comment_count=post.c.reviewed_comment_count + reviewed_delta))
+
+
+@event.listens_for(Post, 'after_insert')
+def post_inserted(mapper, connection, target):
+    _change_post_count(connection, target.category_id, 1)
+    _change_month_count(connection, target.timestamp, 1)
+
+
+@event.listens_for(Post, 'after_delete')
+def post_deleted(mapper, connection, target):
+    _change_post_count(connection, target.category_id, -1)
+    _change_month_count(connection, target.timestamp, -1)
+
+
+@event.listens_for(Post, 'after_update')
+def post_updated(mapper, connection, target):
+    state = db.inspect(target)
+    history = state.attrs.timestamp.history
+    if history.has_changes():
+        for timestamp in history.deleted:
+            _change_month_count(connection, timestamp, -1)
+        _change_month_count(connection, target.timestamp, 1)
+    history = state.attrs.category.history
+    if history.has_changes():
+        old_ids = [category.id for category in history.deleted if category is not None]
+    else:
+        history = state.attrs.category_id.history
+        if not history.has_changes():
+            return
+        old_ids = [category_id for category_id in history.deleted]
+    for category_id in old_ids:
+        _change_post_count(connection, category_id, -1)
+    _change_post_count(connection, target.category_id, 1)
+
+
+@event.listens_for(Comment, 'after_insert')
+def comment_inserted(mapper, connection, target):
+    _change_comment_count(connection, target.post_id, 1, 1 if target.reviewed else 0)
+
+
+@event.listens_for(Comment, 'after_delete')
+def comment_deleted(mapper, connection, target):
+    _change_comment_count(connection, target.post_id, -1, -1 if target.reviewed else 0)
+
+
+@event.listens_for(Comment, 'after_update')
+def comment_updated(mapper, connection, target):
+    history = db.inspect(target).attrs.reviewed.history
+    if not history.has_changes():
+        return
+    was_reviewed = bool(history.deleted and history.deleted[0])
+    if was_reviewed != bool(target.reviewed):
+        _change_comment_count(connection, target.post_id, 0, 1 if target.reviewed else -1)
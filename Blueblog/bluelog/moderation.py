@@ -0,0 +1,123 @@
+from datetime import datetime
+
+from bluelog.caching import site_cache, page_cache
+from bluelog.extensions import db
+from bluelog.models import Post, Comment
+from bluelog.search import index_comments, remove_comments
+
+# Bound parameters per IN list, below the SQLite limit of 999.
+CHUNK_SIZE = 500
+
+
+def _chunks(values, size=CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _integer(value, name):
+    # int() would accept a bool or truncate a float, and fails with TypeError on a list.
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError('%s must be an integer.' % name)
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError('%s must be an integer.' % name)
+
+
+def _string(value, name):
+    if not isinstance(value, str):
+        raise ValueError('%s must be a string.' % name)
+    return value.strip()
+
+
+def parse_criteria(data):
+    """Read the comment selection of a bulk request from form or JSON ``data``.
+
+    ``ids`` (a list or comma separated), ``post_id``, ``email`` and ``before``
+    (ISO date) are combined with AND, ``unread`` limits them to unreviewed
+    comments. Raises ``ValueError`` for malformed values or an empty selection.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Send the selection as an object.')
+    criteria = {}
+    ids = data.get('ids')
+    if ids:
+        if isinstance(ids, str):
+            ids = [part for part in ids.split(',') if part.strip()]
+        elif not isinstance(ids, list):
+            raise ValueError('ids must be a list or comma separated.')
+        criteria['ids'] = [_integer(comment_id, 'ids') for comment_id in ids]
+    if data.get('post_id'):
+        criteria['post_id'] = _integer(data['post_id'], 'post_id')
+    if data.get('email'):
+        criteria['email'] = _string(data['email'], 'email')
+    if data.get('before'):
+        before = _string(data['before'], 'before')
+        criteria['before'] = datetime.strptime(before, '%Y-%m-%dT%H:%M:%S' if 'T' in before else '%Y-%m-%d')
+    if not criteria:
+        raise ValueError('Give ids, post_id, email or before to select comments.')
+    criteria['unread'] = data.get('unread') in (True, 'true', '1', 'on', 'y')
+    return criteria
+
+
+def _matching(criteria):
+    query = db.session.query(Comment.id)
+    if criteria.get('post_id') is not None:
+        query = query.filter(Comment.post_id == criteria['post_id'])
+    if criteria.get('email'):
+        query = query.filter(Comment.email == criteria['email'])
+    if criteria.get('before') is not None:
+        query = query.filter(Comment.timestamp < criteria['before'])
+    if criteria.get('unread'):
+        query = query.filter(Comment.reviewed == db.false())
+    if criteria.get('ids') is None:
+        return [comment_id for comment_id, in query]
+    matched = []
+    for chunk in _chunks(criteria['ids']):
+        matched.extend(comment_id for comment_id, in query.filter(Comment.id.in_(chunk)))
+    return matched
+
+
+def _post_ids(comment_ids):
+    post_ids = set()
+    for chunk in _chunks(comment_ids):
+        post_ids.update(post_id for post_id, in db.session.query(Comment.post_id).
+                        filter(Comment.id.in_(chunk)).distinct() if post_id is not None)
+    return post_ids
+
+
+def _refresh(post_ids):
+    for chunk in _chunks(post_ids):
+        Post.recount(chunk, touch=True)
+    db.session.commit()
+    db.session.expire_all()
+    site_cache.invalidate('unread_comments')
+    page_cache.purge(*['post:%d' % post_id for post_id in post_ids])
+
+
+def approve_comments(criteria):
+    """Mark the selected unreviewed comments reviewed, returns the counts of the change."""
+    comment_ids = _matching(dict(criteria, unread=True))
+    post_ids = _post_ids(comment_ids)
+    for chunk in _chunks(comment_ids):
+        Comment.query.filter(Comment.id.in_(chunk)).update({'reviewed': True}, synchronize_session=False)
+    index_comments(comment_ids)
+    _refresh(post_ids)
+    return dict(approved=len(comment_ids), posts=len(post_ids))
+
+
+def delete_comments(criteria):
+    """Delete the selected comments and the replies below them, returns the counts of the change."""
+    selected = _matching(criteria)
+    # A reply always has a higher id than its parent, deleting the highest ids
+    # first never leaves a reply pointing at a deleted row, even with per
+    # statement foreign key checks.
+    comment_ids = sorted(set(comment_id for chunk in _chunks(selected) for comment_id in Comment.thread_ids(chunk)),
+                         reverse=True)
+    post_ids = _post_ids(comment_ids)
+    remove_comments(comment_ids)
+    for chunk in _chunks(comment_ids):
+        Comment.query.filter(Comment.id.in_(chunk)).delete(synchronize_session=False)
+    _refresh(post_ids)
+    return dict(deleted=len(comment_ids), replies=len(comment_ids) - len(selected), posts=len(post_ids))
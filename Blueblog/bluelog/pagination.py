@@ -0,0 +1,111 @@
+from datetime import datetime
+from math import ceil
+
+from flask import abort, current_app, request
+from sqlalchemy import and_, or_
+
+CURSOR_TIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+class Pagination(object):
+    """A page of rows that ``render_pagination`` and ``render_pager`` can render.
+
+    In keyset mode ``prev_num`` and ``next_num`` are cursor strings rather than
+    page numbers; they travel in the ``page`` query argument like a number would.
+    """
+
+    def __init__(self, items, page, per_page, total, has_prev, has_next, prev_num, next_num):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.prev_num = prev_num if has_prev else None
+        self.next_num = next_num if has_next else None
+
+    @property
+    def pages(self):
+        if self.total is None:
+            return None
+        return int(ceil(self.total / float(self.per_page))) if self.per_page else 0
+
+    def iter_pages(self, *args, **kwargs):
+        # Only the first and the current page can be linked without a cursor.
+        if self.page > 1:
+            yield 1
+        if self.page > 2:
+            yield None
+        yield self.page
+
+
+def make_cursor(page, direction, row):
+    return '%d~%s~%s~%d' % (page, direction, row.timestamp.strftime(CURSOR_TIME_FORMAT), row.id)
+
+
+def parse_cursor(value):
+    try:
+        page, direction, timestamp, row_id = value.split('~')
+        return int(page), direction, datetime.strptime(timestamp, CURSOR_TIME_FORMAT), int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def paginate(query, model, per_page, page=None):
+    """Paginate ``query`` newest first by ``(model.timestamp, model.id)``.
+
+    ``BLUELOG_PAGINATION`` selects ``offset`` (LIMIT/OFFSET) or ``keyset`` (seek on
+    the last row seen) links, and ``BLUELOG_PAGINATION_COUNT`` can turn off the
+    ``COUNT(*)`` used for ``total``. Cursor links are honoured in either mode.
+    """
+    if page is None:
+        page = request.args.get('page', '1')
+    keyset = current_app.config['BLUELOG_PAGINATION'] == 'keyset'
+    with_count = current_app.config['BLUELOG_PAGINATION_COUNT']
+    cursor = parse_cursor(page)
+
+    if cursor is None:
+        try:
+            number = max(int(page), 1)
+        except (TypeError, ValueError):
+            number = 1
+        if not keyset and with_count:
+            return query.order_by(model.timestamp.desc(), model.id.desc()).paginate(number, per_page=per_page)
+    else:
+        number = max(cursor[0], 1)
+
+    total = query.order_by(None).count() if with_count else None
+
+    if cursor is None:
+        rows = query.order_by(model.timestamp.desc(), model.id.desc()).\
+            offset((number - 1) * per_page).limit(per_page + 1).all()
+        has_prev, has_next = number > 1, len(rows) > per_page
+        rows = rows[:per_page]
+    elif cursor[1] == 'a':
+        timestamp, row_id = cursor[2:]
+        rows = query.filter(or_(model.timestamp < timestamp,
+                                and_(model.timestamp == timestamp, model.id < row_id))).\
+            order_by(model.timestamp.desc(), model.id.desc()).limit(per_page + 1).all()
+        has_prev, has_next = True, len(rows) > per_page
+        rows = rows[:per_page]
+    else:
+        timestamp, row_id = cursor[2:]
+        rows = query.filter(or_(model.timestamp > timestamp,
+                                and_(model.timestamp == timestamp, model.id > row_id))).\
+            order_by(model.timestamp.asc(), model.id.asc()).limit(per_page + 1).all()
+        has_prev, has_next = len(rows) > per_page, True
+        rows = rows[:per_page][::-1]
+        if not has_prev:
+            number = 1
+
+    if not rows:
+        if number > 1:
+            abort(404)
+        return Pagination(rows, number, per_page, total, False, False, None, None)
+
+    if keyset or cursor is not None:
+        prev_num = 1 if number == 2 else make_cursor(number - 1, 'b', rows[0])
+        next_num = make_cursor(number + 1, 'a', rows[-1])
+    else:
+        prev_num, next_num = number - 1, number + 1
+    return Pagination(rows, number, per_page, total, has_prev, has_next, prev_num, next_num)
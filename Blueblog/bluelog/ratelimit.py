@@ -0,0 +1,187 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import abort, current_app, g, request
+
+
+def _refill(tokens, updated, capacity, period, now):
+    return min(float(capacity), tokens + (now - updated) * capacity / period)
+
+
+def _wait(tokens, capacity, period):
+    """Seconds until a bucket holding ``tokens`` has one to give."""
+    return (1 - tokens) * period / capacity
+
+
+class MemoryStore(object):
+    """Buckets of this process only, the least recently used are dropped when full."""
+
+    def __init__(self, max_buckets=10000):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, scope, buckets, now):
+        with self._lock:
+            levels = []
+            for key, capacity, period in buckets:
+                tokens, updated = self._buckets.get(key, (capacity, now))
+                levels.append(_refill(tokens, updated, capacity, period, now))
+            retry_after = max([_wait(tokens, capacity, period) for tokens, (key, capacity, period)
+                               in zip(levels, buckets) if tokens < 1] or [0])
+            # Only take a token when every bucket has one, a rejected request costs nothing.
+            for tokens, (key, capacity, period) in zip(levels, buckets):
+                self._buckets[key] = (tokens if retry_after else tokens - 1, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+            counter = self._counters.setdefault(scope, [0, 0])
+            counter[1 if retry_after else 0] += 1
+        return retry_after
+
+    def stats(self):
+        with self._lock:
+            return dict((scope, tuple(counter)) for scope, counter in self._counters.items())
+
+
+class SQLiteStore(object):
+    """Buckets in a SQLite file of their own, so the limits hold across the workers of a host."""
+
+    prune_every = 1000
+
+    def __init__(self, path, max_idle=24 * 60 * 60):
+        self.path = path
+        self.max_idle = max_idle
+        self._local = threading.local()
+        self._calls = 0
+
+    def _connection(self):
+        # Opened on first use, a connection made before the workers fork must not be shared by them.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket '
+                               '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS counter '
+                               '(scope TEXT PRIMARY KEY, allowed INTEGER NOT NULL, rejected INTEGER NOT NULL)')
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def acquire(self, scope, buckets, now):
+        connection = self._connection()
+        # IMMEDIATE takes the write lock up front, two workers never read the same level.
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            levels = []
+            for key, capacity, period in buckets:
+                row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+                tokens, updated = row if row is not None else (capacity, now)
+                levels.append(_refill(tokens, updated, capacity, period, now))
+            retry_after = max([_wait(tokens, capacity, period) for tokens, (key, capacity, period)
+                               in zip(levels, buckets) if tokens < 1] or [0])
+            connection.executemany('INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                                   [(key, tokens if retry_after else tokens - 1, now)
+                                    for tokens, (key, capacity, period) in zip(levels, buckets)])
+            connection.execute('INSERT OR IGNORE INTO counter (scope, allowed, rejected) VALUES (?, 0, 0)',
+                               (scope,))
+            column = 'rejected' if retry_after else 'allowed'
+            connection.execute('UPDATE counter SET %s = %s + 1 WHERE scope = ?' % (column, column), (scope,))
+            self._calls += 1
+            if self._calls % self.prune_every == 0:
+                connection.execute('DELETE FROM bucket WHERE updated < ?', (now - self.max_idle,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return retry_after
+
+    def stats(self):
+        return dict((scope, (allowed, rejected)) for scope, allowed, rejected in
+                    self._connection().execute('SELECT scope, allowed, rejected FROM counter'))
+
+
+def _identity(kind):
+    if '+' in kind:
+        values = [_identity(part) for part in kind.split('+')]
+        return '|'.join(values) if all(values) else ''
+    if kind == 'ip':
+        return request.remote_addr
+    # Read the raw field, the form is not validated before the request is admitted.
+    return request.form.get(kind, '').strip().lower()[:254]
+
+
+class RateLimiter(object):
+    """Token buckets per client for the endpoints that cost the most.
+
+    ``BLUELOG_RATE_LIMITS`` maps a scope to ``(kind, capacity, period)`` rules:
+    a bucket of ``capacity`` tokens per IP address (``ip``), per form field
+    value or per combination of them (``ip+username``), refilled over ``period``
+    seconds. A request takes one token from each of its buckets and is answered
+    with 429 when one of them is empty. Behind a reverse proxy the IP address
+    is only the client's with ``BLUELOG_PROXY_FIX`` set.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config.get('BLUELOG_RATE_LIMIT')
+        if backend == 'memory':
+            backend = MemoryStore(app.config['BLUELOG_RATE_LIMIT_BUCKETS'])
+        elif backend == 'sqlite':
+            path = app.config['BLUELOG_RATE_LIMIT_DB'] or os.path.join(app.instance_path, 'ratelimit.db')
+            # A bare file name lives in the working directory, there is nothing to create.
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            backend = SQLiteStore(path)
+        app.extensions['rate_limiter'] = backend
+
+    @property
+    def store(self):
+        return current_app.extensions.get('rate_limiter')
+
+    def check(self, scope):
+        store = self.store
+        if store is None:
+            return
+        buckets = []
+        for kind, capacity, period in current_app.config['BLUELOG_RATE_LIMITS'].get(scope, ()):
+            value = _identity(kind)
+            if value:
+                buckets.append(('%s:%s:%s' % (scope, kind, value), capacity, period))
+        if not buckets:
+            return
+        retry_after = store.acquire(scope, buckets, time.time())
+        if retry_after:
+            g.retry_after = int(math.ceil(retry_after))
+            abort(429)
+
+    def limit(self, scope, methods=('POST',), exempt=None):
+        """Admit the ``methods`` requests of a view through the buckets of ``scope``.
+
+        Apply it below the route, it runs before the form is read or the database touched.
+        """
+        def decorator(f):
+            @wraps(f)
+            def decorated(*args, **kwargs):
+                if request.method in methods and not (exempt is not None and exempt()):
+                    self.check(scope)
+                return f(*args, **kwargs)
+            return decorated
+        return decorator
+
+    def stats(self):
+        """``{scope: (allowed, rejected)}``, of every worker with the SQLite store."""
+        store = self.store
+        return store.stats() if store is not None else {}
+
+
+limiter = RateLimiter()
@@ -0,0 +1,114 @@
+import re
+from html import escape
+from html.parser import HTMLParser
+
+from markupsafe import Markup
+
+try:
+    import bleach
+except ImportError:  # pragma: no cover
+    bleach = None
+
+ALLOWED_TAGS = [
+    'a', 'abbr', 'b', 'blockquote', 'br', 'caption', 'code', 'del', 'div', 'em', 'figcaption', 'figure',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'li', 'ol', 'p', 'pre', 's', 'span', 'strong',
+    'sub', 'sup', 'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'u', 'ul',
+]
+ALLOWED_ATTRIBUTES = {
+    '*': ['class'],
+    'a': ['href', 'title', 'target', 'rel'],
+    'abbr': ['title'],
+    'img': ['src', 'alt', 'title', 'width', 'height'],
+    'td': ['colspan', 'rowspan'],
+    'th': ['colspan', 'rowspan'],
+}
+ALLOWED_PROTOCOLS = ['http', 'https', 'mailto']
+URL_ATTRIBUTES = {'href', 'src'}
+VOID_TAGS = {'br', 'hr', 'img'}
+# Dropped together with everything inside them.
+SKIP_CONTENT_TAGS = {'script', 'style', 'iframe', 'object', 'embed', 'template', 'noscript'}
+
+EXCERPT_LENGTH = 255
+
+_scheme_re = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.-]*):')
+_url_junk_re = re.compile(r'[\x00-\x20]+')
+
+
+def _safe_url(url):
+    match = _scheme_re.match(_url_junk_re.sub('', url))
+    return match is None or match.group(1).lower() in ALLOWED_PROTOCOLS
+
+
+class _Sanitizer(HTMLParser):
+    """Whitelist sanitizer used when bleach is not installed."""
+
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.output = []
+        self.open_tags = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_CONTENT_TAGS:
+            self.skipping += 1
+            return
+        if self.skipping or tag not in ALLOWED_TAGS:
+            return
+        allowed = set(ALLOWED_ATTRIBUTES.get(tag, [])) | set(ALLOWED_ATTRIBUTES['*'])
+        parts = [tag]
+        for name, value in attrs:
+            if name not in allowed or value is None:
+                continue
+            if name in URL_ATTRIBUTES and not _safe_url(value):
+                continue
+            parts.append('%s="%s"' % (name, escape(value, quote=True)))
+        self.output.append('<%s>' % ' '.join(parts))
+        if tag not in VOID_TAGS:
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_CONTENT_TAGS:
+            self.skipping = max(self.skipping - 1, 0)
+            return
+        if self.skipping or tag not in self.open_tags:
+            return
+        while self.open_tags:
+            current = self.open_tags.pop()
+            self.output.append('</%s>' % current)
+            if current == tag:
+                break
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.output.append(escape(data, quote=False))
+
+    def close(self):
+        HTMLParser.close(self)
+        while self.open_tags:
+            self.output.append('</%s>' % self.open_tags.pop())
+        return ''.join(self.output)
+
+
+def sanitize_html(html):
+    """Reduce editor HTML to a whitelist of tags and attributes that is safe to serve as is."""
+    if not html:
+        return ''
+    if bleach is not None:
+        return bleach.clean(html, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES,
+                            protocols=ALLOWED_PROTOCOLS, strip=True)
+    sanitizer = _Sanitizer()
+    sanitizer.feed(html)
+    return sanitizer.close()
+
+
+def make_excerpt(html, length=EXCERPT_LENGTH, end='...', leeway=5):
+    """Plain text excerpt, the same as ``body|striptags|truncate`` used to give in the templates."""
+    text = Markup(html or '').striptags()
+    if len(text) <= length + leeway:
+        return text
+    return text[:length - len(end)].rsplit(' ', 1)[0] + end
@@ -0,0 +1,39 @@
+from sqlalchemy.schema import CreateColumn
+
+from bluelog.extensions import db
+
+
+def upgrade_database():
+    """Bring an existing database up to the current models without dropping data.
+
+    Missing tables are created, missing columns are added with ``ALTER TABLE``
+    and missing indexes are built. Returns a list of ``(kind, name)`` changes.
+    """
+    engine = db.engine
+    preparer = engine.dialect.identifier_preparer
+    inspector = db.inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    changes = []
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            table.create(engine)
+            changes.append(('table', table.name))
+            continue
+
+        existing_columns = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_ddl = CreateColumn(column).compile(dialect=engine.dialect)
+            engine.execute('ALTER TABLE %s ADD COLUMN %s' % (preparer.format_table(table), column_ddl))
+            if column.default is not None and column.default.is_scalar and column.server_default is None:
+                engine.execute(table.update().where(column.is_(None)).values({column.name: column.default.arg}))
+            changes.append(('column', '%s.%s' % (table.name, column.name)))
+
+        existing_indexes = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(engine)
+                changes.append(('index', index.name))
+    return changes
@@ -0,0 +1,273 @@
+import math
+import re
+from collections import Counter, namedtuple
+
+from flask import current_app, url_for
+from markupsafe import Markup, escape
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import joinedload, load_only
+
+from bluelog.extensions import db
+from bluelog.models import Post, Comment, SearchEntry
+from bluelog.pagination import Pagination
+
+SearchResult = namedtuple('SearchResult', ['doc_type', 'id', 'title', 'snippet', 'url', 'timestamp'])
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+TITLE_WEIGHT = 3
+MAX_QUERY_TERMS = 8
+SNIPPET_LENGTH = 160
+HIGHLIGHT_START, HIGHLIGHT_END = '\x02', '\x03'
+
+FTS_TABLE = 'search_fts'
+CREATE_FTS_TABLE = "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(title, body, tokenize='unicode61')" % FTS_TABLE
+
+
+def tokenize(text):
+    return [token[:64] for token in TOKEN_RE.findall((text or '').lower()) if len(token) > 1]
+
+
+def plain_text(html):
+    return Markup(html or '').striptags()
+
+
+def _rowid(doc_type, doc_id):
+    # Posts and comments share the FTS table, the low bit tells them apart.
+    return doc_id * 2 + (1 if doc_type == 'comment' else 0)
+
+
+def _create_fts_table(choice):
+    """Create the FTS5 table in the session's transaction, ``False`` when SQLite lacks FTS5."""
+    try:
+        db.session.execute(CREATE_FTS_TABLE)
+    except OperationalError as e:
+        # Only a missing module means FTS5 is unavailable, anything else (a lock) is passed on.
+        if choice == 'fts5' or 'no such module' not in str(e):
+            raise
+        current_app.logger.info('SQLite FTS5 is not available, using the built-in search index')
+        return False
+    return True
+
+
+def use_fts():
+    state = current_app.extensions.setdefault('search', {})
+    if 'fts' in state:
+        return state['fts']
+    choice = current_app.config['BLUELOG_SEARCH_BACKEND']
+    if choice not in ('auto', 'fts5') or db.engine.dialect.name != 'sqlite':
+        state['fts'] = False
+        return False
+    # Probe on the session's own connection, a second one would wait for the
+    # write lock this request may already hold.
+    if db.session.execute('SELECT 1 FROM sqlite_master WHERE name = :name', {'name': FTS_TABLE}).first():
+        state['fts'] = True
+        return True
+    if not _create_fts_table(choice):
+        state['fts'] = False
+        return False
+    # Not cached until the table is committed and found by the probe above.
+    return True
+
+
+def create_search_table():
+    """Create the FTS5 table up front, run by initdb, upgradedb and forge. Returns whether it is new."""
+    current_app.extensions.setdefault('search', {}).pop('fts', None)
+    choice = current_app.config['BLUELOG_SEARCH_BACKEND']
+    if choice not in ('auto', 'fts5') or db.engine.dialect.name != 'sqlite':
+        return False
+    if db.session.execute('SELECT 1 FROM sqlite_master WHERE name = :name', {'name': FTS_TABLE}).first():
+        return False
+    created = _create_fts_table(choice)
+    db.session.commit()
+    return created
+
+
+def drop_search_table():
+    current_app.extensions.setdefault('search', {}).pop('fts', None)
+    if db.engine.dialect.name == 'sqlite':
+        db.session.execute('DROP TABLE IF EXISTS %s' % FTS_TABLE)
+        db.session.commit()
+
+
+def _index_document(doc_type, doc_id, title, text):
+    if use_fts():
+        rowid = _rowid(doc_type, doc_id)
+        db.session.execute('DELETE FROM %s WHERE rowid = :rowid' % FTS_TABLE, {'rowid': rowid})
+        db.session.execute('INSERT INTO %s (rowid, title, body) VALUES (:rowid, :title, :body)' % FTS_TABLE,
+                           {'rowid': rowid, 'title': title, 'body': text})
+        return
+    weights = Counter(tokenize(text))
+    for term in tokenize(title):
+        weights[term] += TITLE_WEIGHT
+    SearchEntry.query.filter_by(doc_type=doc_type, doc_id=doc_id).delete(synchronize_session=False)
+    if weights:
+        db.session.execute(SearchEntry.__table__.insert(),
+                           [dict(term=term, doc_type=doc_type, doc_id=doc_id, weight=weight)
+                            for term, weight in weights.items()])
+
+
+def _remove_documents(doc_type, doc_ids):
+    doc_ids = list(doc_ids)
+    if not doc_ids:
+        return
+    if use_fts():
+        db.session.execute('DELETE FROM %s WHERE rowid IN (%s)' %
+                           (FTS_TABLE, ', '.join(str(_rowid(doc_type, int(doc_id))) for doc_id in doc_ids)))
+        return
+    for start in range(0, len(doc_ids), 500):
+        SearchEntry.query.filter(SearchEntry.doc_type == doc_type,
+                                 SearchEntry.doc_id.in_(doc_ids[start:start + 500])).\
+            delete(synchronize_session=False)
+
+
+def index_post(post):
+    db.session.flush()
+    _index_document('post', post.id, post.title, plain_text(post.body))
+
+
+def remove_post(post):
+    """Drop a post and its comments from the index, call it before deleting the post."""
+    _remove_documents('comment', [comment_id for comment_id, in
+                                  db.session.query(Comment.id).filter(Comment.post_id == post.id)])
+    _remove_documents('post', [post.id])
+
+
+def index_comment(comment):
+    db.session.flush()
+    if comment.reviewed:
+        _index_document('comment', comment.id, '', comment.body)
+    else:
+        _remove_documents('comment', [comment.id])
+
+
+def remove_comment(comment):
+    """Drop a comment and the replies deleted along with it from the index."""
+    _remove_documents('comment', Comment.thread_ids([comment.id]))
+
+
+def index_comments(comment_ids):
+    """Index the reviewed comments of ``comment_ids`` with one insert per batch."""
+    comment_ids = list(comment_ids)
+    _remove_documents('comment', comment_ids)
+    for start in range(0, len(comment_ids), 500):
+        comments = db.session.query(Comment.id, Comment.body).\
+            filter(Comment.id.in_(comment_ids[start:start + 500]), Comment.reviewed == db.true()).all()
+        if not comments:
+            continue
+        if use_fts():
+            db.session.execute('INSERT INTO %s (rowid, title, body) VALUES (:rowid, :title, :body)' % FTS_TABLE,
+                               [{'rowid': _rowid('comment', comment_id), 'title': '', 'body': body}
+                                for comment_id, body in comments])
+            continue
+        rows = [dict(term=term, doc_type='comment', doc_id=comment_id, weight=weight)
+                for comment_id, body in comments for term, weight in Counter(tokenize(body)).items()]
+        if rows:
+            db.session.execute(SearchEntry.__table__.insert(), rows)
+
+
+def remove_comments(comment_ids):
+    """Drop comments from the index, the caller passes the replies deleted with them too."""
+    _remove_documents('comment', comment_ids)
+
+
+def reindex(batch_size=1000):
+    if use_fts():
+        db.session.execute('DELETE FROM %s' % FTS_TABLE)
+    else:
+        SearchEntry.query.delete(synchronize_session=False)
+    posts = comments = 0
+    for post in Post.query.options(load_only('id', 'title', 'body')).order_by(Post.id).yield_per(batch_size):
+        _index_document('post', post.id, post.title, plain_text(post.body))
+        posts += 1
+    for comment in Comment.query.filter_by(reviewed=True).options(load_only('id', 'body')).\
+            order_by(Comment.id).yield_per(batch_size):
+        _index_document('comment', comment.id, '', comment.body)
+        comments += 1
+    db.session.commit()
+    return posts, comments
+
+
+def _highlight(text, terms):
+    """Cut a window of ``text`` around the first matching term and mark every match."""
+    lowered = text.lower()
+    positions = [lowered.find(term) for term in terms if lowered.find(term) >= 0]
+    start = max(min(positions) - SNIPPET_LENGTH // 4, 0) if positions else 0
+    snippet = text[start:start + SNIPPET_LENGTH]
+    if terms:
+        pattern = re.compile('|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True)),
+                             re.IGNORECASE)
+        snippet = pattern.sub(lambda m: HIGHLIGHT_START + m.group(0) + HIGHLIGHT_END, snippet)
+    prefix = '…' if start > 0 else ''
+    suffix = '…' if start + SNIPPET_LENGTH < len(text) else ''
+    return prefix + snippet + suffix
+
+
+def _render_snippet(snippet):
+    return Markup(escape(snippet).replace(HIGHLIGHT_START, Markup('<mark>')).
+                  replace(HIGHLIGHT_END, Markup('</mark>')))
+
+
+def _rank_fts(terms, page, per_page):
+    match = ' '.join('"%s"' % term for term in terms)
+    total = db.session.execute('SELECT count(*) FROM %s WHERE %s MATCH :match' % (FTS_TABLE, FTS_TABLE),
+                               {'match': match}).scalar()
+    rows = db.session.execute(
+        "SELECT rowid, snippet(%s, 1, :start, :end, '…', 24) FROM %s WHERE %s MATCH :match "
+        "ORDER BY bm25(%s, %d.0, 1.0) LIMIT :limit OFFSET :offset" %
+        (FTS_TABLE, FTS_TABLE, FTS_TABLE, FTS_TABLE, TITLE_WEIGHT),
+        {'match': match, 'start': HIGHLIGHT_START, 'end': HIGHLIGHT_END,
+         'limit': per_page, 'offset': (page - 1) * per_page}).fetchall()
+    ranked = [('comment' if rowid % 2 else 'post', rowid // 2, snippet) for rowid, snippet in rows]
+    return total, ranked
+
+
+def _rank_index(terms, page, per_page):
+    document_count = Post.query.count() + Comment.query.filter_by(reviewed=True).count()
+    frequencies = dict(db.session.query(SearchEntry.term, db.func.count()).
+                       filter(SearchEntry.term.in_(terms)).group_by(SearchEntry.term))
+    if len(frequencies) < len(terms):
+        return 0, []
+    idf = db.case([(SearchEntry.term == term, math.log(1.0 + document_count / float(frequency)))
+                   for term, frequency in frequencies.items()])
+    score = db.func.sum(SearchEntry.weight * idf).label('score')
+    matches = db.session.query(SearchEntry.doc_type, SearchEntry.doc_id, score).\
+        filter(SearchEntry.term.in_(terms)).group_by(SearchEntry.doc_type, SearchEntry.doc_id).\
+        having(db.func.count() == len(terms))
+    total = matches.order_by(None).from_self().count()
+    rows = matches.order_by(score.desc(), SearchEntry.doc_id.desc()).\
+        limit(per_page).offset((page - 1) * per_page).all()
+    return total, [(doc_type, doc_id, None) for doc_type, doc_id, score in rows]
+
+
+def search(query, page=1, per_page=None):
+    """Ranked full-text search over posts and reviewed comments, returns a ``Pagination``."""
+    per_page = per_page or current_app.config['BLUELOG_SEARCH_RESULT_PER_PAGE']
+    terms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return Pagination([], page, per_page, 0, False, False, None, None)
+    if use_fts():
+        total, ranked = _rank_fts(terms, page, per_page)
+    else:
+        total, ranked = _rank_index(terms, page, per_page)
+
+    post_ids = [doc_id for doc_type, doc_id, snippet in ranked if doc_type == 'post']
+    comment_ids = [doc_id for doc_type, doc_id, snippet in ranked if doc_type == 'comment']
+    posts = dict((post.id, post) for post in Post.query.filter(Post.id.in_(post_ids))) if post_ids else {}
+    comments = dict((comment.id, comment) for comment in Comment.query.filter(Comment.id.in_(comment_ids)).
+                    options(joinedload(Comment.post).load_only('id', 'title'))) if comment_ids else {}
+
+    items = []
+    for doc_type, doc_id, snippet in ranked:
+        if doc_type == 'post' and doc_id in posts:
+            post = posts[doc_id]
+            snippet = snippet or _highlight(plain_text(post.body), terms)
+            items.append(SearchResult('post', post.id, post.title, _render_snippet(snippet),
+                                      url_for('blog.show_post', post_id=post.id), post.timestamp))
+        elif doc_type == 'comment' and doc_id in comments:
+            comment = comments[doc_id]
+            snippet = snippet or _highlight(comment.body, terms)
+            items.append(SearchResult('comment', comment.id, comment.post.title, _render_snippet(snippet),
+                                      url_for('blog.show_post', post_id=comment.post_id) + '#comments',
+                                      comment.timestamp))
+    has_next = page * per_page < total
+    return Pagination(items, page, per_page, total, page > 1, has_next, page - 1, page + 1)
@@ -8,6 +8,18 @@ class BaseConfig(object):
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # None leaves the SQLAlchemy default, the statement timeout is in milliseconds
+    BLUELOG_DB_POOL_SIZE = None
+    BLUELOG_DB_MAX_OVERFLOW = None
+    BLUELOG_DB_POOL_RECYCLE = None
+    BLUELOG_DB_POOL_TIMEOUT = None
+    BLUELOG_DB_STATEMENT_TIMEOUT = None
+    # seconds a SQLite connection waits for a lock before failing
+    BLUELOG_DB_BUSY_TIMEOUT = 15
+    BLUELOG_SQLITE_PRAGMAS = {}
+    BLUELOG_REPLICA_DATABASE_URI = os.getenv('REPLICA_DATABASE_URI')
+    BLUELOG_REPLICA_BLUEPRINTS = ['blog']
+
     MAIL_SERVER = os.getenv('MAIL_SERVER')
     MAIL_PORT = 587
     MAIL_USE_SSL = True
@@ -15,13 +27,86 @@ class BaseConfig(object):
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
     MAIL_DEFAULT_SENDER = ('Bluelog Admin', MAIL_USERNAME)
 
+    # In-process mail threads, set to 0 when a separate `flask mail-worker` runs
+    BLUELOG_MAIL_WORKERS = int(os.getenv('BLUELOG_MAIL_WORKERS', 1))
+    BLUELOG_MAIL_BATCH_SIZE = 50
+    BLUELOG_MAIL_POLL_INTERVAL = 5
+    BLUELOG_MAIL_LEASE = 5 * 60
+    BLUELOG_MAIL_MAX_ATTEMPTS = 5
+    BLUELOG_MAIL_RETRY_DELAY = 60
+    BLUELOG_MAIL_DIGEST_WINDOW = 10 * 60
+
     BLUELOG_EMAIL = os.getenv('BLUELOG_EMAIL')
     BLUELOG_POST_PER_PAGE = 10
     BLUELOG_MANAGE_POST_PER_PAGE = 15
     BLUELOG_COMMENT_PER_PAGE = 15
+    # None writes each comment in its request, 'memory' (per process) or 'disk' (a spool
+    # shared by the workers of a host) buffer reader comments for a background writer
+    BLUELOG_COMMENT_BUFFER = os.getenv('BLUELOG_COMMENT_BUFFER')
+    BLUELOG_COMMENT_BUFFER_SIZE = 1000
+    BLUELOG_COMMENT_BATCH_SIZE = 100
+    BLUELOG_COMMENT_FLUSH_INTERVAL = 0.5
+    BLUELOG_COMMENT_SPOOL_DIR = os.getenv('BLUELOG_COMMENT_SPOOL_DIR')
+    # 'offset' or 'keyset', the latter avoids deep OFFSET scans on large tables
+    BLUELOG_PAGINATION = os.getenv('BLUELOG_PAGINATION', 'offset')
+    BLUELOG_PAGINATION_COUNT = True
+    BLUELOG_SEARCH_RESULT_PER_PAGE = 20
+    # the most used tags shown in the sidebar cloud
+    BLUELOG_TAG_CLOUD_SIZE = 30
+    # 'auto' uses SQLite FTS5 when available, 'index' forces the built-in inverted index
+    BLUELOG_SEARCH_BACKEND = os.getenv('BLUELOG_SEARCH_BACKEND', 'auto')
 
     BLUELOG_UPLOAD_PATH = os.path.join(basedir, 'uploads')
     BLUELOG_ALLOWED_IMAGE_EXTENSIONS = ['jpg', 'png', 'jpeg', 'gif']
+    # max width of each resized copy, every copy is also written as WebP (needs Pillow)
+    BLUELOG_IMAGE_VARIANTS = {'thumb': 320, 'medium': 800, 'large': 1600}
+    BLUELOG_IMAGE_QUALITY = 85
+    BLUELOG_IMAGE_WORKERS = 2
+    BLUELOG_UPLOAD_CACHE_TIMEOUT = 365 * 24 * 60 * 60
+    # internal location nginx serves BLUELOG_UPLOAD_PATH from, sent as X-Accel-Redirect
+    BLUELOG_UPLOAD_ACCEL_PREFIX = os.getenv('BLUELOG_UPLOAD_ACCEL_PREFIX')
+    BLUELOG_FEED_POST_COUNT = 20
+    BLUELOG_FEED_CACHE_DIR = os.getenv('BLUELOG_FEED_CACHE_DIR')
+    # the most URLs one sitemap file may list, larger sitemaps are split into parts
+    BLUELOG_SITEMAP_URLS = 50000
+    BLUELOG_THEMES = {'perfect_blue': 'Perfect Blue', 'black_swan': 'Black Swan'}
+    BLUELOG_ASSETS_PATH = os.getenv('BLUELOG_ASSETS_PATH', os.path.join(basedir, 'assets'))
+    BLUELOG_EXPORT_PATH = os.getenv('BLUELOG_EXPORT_PATH', os.path.join(basedir, 'public'))
+    # set while export-static renders, static pages have no session to bind a CSRF token to
+    BLUELOG_STATIC_EXPORT = False
+
+    BLUELOG_CACHE_STAMP_DIR = os.getenv('BLUELOG_CACHE_STAMP_DIR')
+    BLUELOG_SITE_CACHE_TIMEOUT = 60 * 60
+
+    # None, 'lru' (per process) or 'filesystem' (shared by all workers on a host)
+    BLUELOG_PAGE_CACHE = None
+    # entries kept by either backend, the filesystem one also deletes those older than the timeout
+    BLUELOG_PAGE_CACHE_SIZE = 500
+    BLUELOG_PAGE_CACHE_DIR = os.getenv('BLUELOG_PAGE_CACHE_DIR')
+    BLUELOG_PAGE_CACHE_TIMEOUT = 60 * 60
+
+    # number of reverse proxies in front of the app, their X-Forwarded-* headers are trusted
+    BLUELOG_PROXY_FIX = int(os.getenv('BLUELOG_PROXY_FIX', 0))
+    # None, 'memory' (per process) or 'sqlite' (shared by all workers on a host)
+    BLUELOG_RATE_LIMIT = os.getenv('BLUELOG_RATE_LIMIT')
+    BLUELOG_RATE_LIMIT_DB = os.getenv('BLUELOG_RATE_LIMIT_DB')
+    BLUELOG_RATE_LIMIT_BUCKETS = 10000
+    # scope: (client key, tokens, seconds to refill them), 'ip', a form field or both joined by '+';
+    # a username alone would let anyone lock the admin out
+    BLUELOG_RATE_LIMITS = {
+        'login': [('ip', 10, 60), ('ip+username', 5, 5 * 60)],
+        'comment': [('ip', 5, 60), ('email', 20, 60 * 60)],
+    }
+
+    BLUELOG_PROFILING = True
+    # True, False or 'admin' to send the header to the signed in admin only
+    BLUELOG_SERVER_TIMING = True
+    BLUELOG_SLOW_QUERY_MS = 100
+    # the same statement shape repeated this many times in one request is reported as N+1
+    BLUELOG_N_PLUS_ONE_THRESHOLD = 5
+    # fraction of requests run under cProfile, 0 disables sampling
+    BLUELOG_PROFILE_SAMPLE_RATE = float(os.getenv('BLUELOG_PROFILE_SAMPLE_RATE', 0))
+    BLUELOG_PROFILE_HISTORY = 200
 
 
 class DevelopmentConfig(BaseConfig):
@@ -31,11 +116,31 @@ class DevelopmentConfig(BaseConfig):
 class TestingConfig(BaseConfig):
     TESTING = True
     WTF_CSRF_ENABLED = False
+    BLUELOG_MAIL_WORKERS = 0
+    BLUELOG_IMAGE_WORKERS = 0
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
 
 
 class ProductionConfig(BaseConfig):
+    BLUELOG_RATE_LIMIT = os.getenv('BLUELOG_RATE_LIMIT', 'sqlite')
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///' + os.path.join(basedir, 'data.db'))
+    BLUELOG_DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+    BLUELOG_DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 20))
+    BLUELOG_DB_POOL_RECYCLE = 30 * 60
+    BLUELOG_DB_POOL_TIMEOUT = 10
+    BLUELOG_DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', 5000))
+    # WAL lets readers go on while a comment is written, the others trade durability
+    # on power loss (not on crashes) and memory for fewer fsyncs and page reads
+    BLUELOG_SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 15000,
+    }
+    BLUELOG_PAGE_CACHE = os.getenv('BLUELOG_PAGE_CACHE', 'filesystem')
+    BLUELOG_SERVER_TIMING = 'admin'
 
 
 config = {
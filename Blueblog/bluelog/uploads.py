@@ -0,0 +1,163 @@
+import hashlib
+import os
+import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, make_response, request, safe_join, send_from_directory
+from werkzeug.exceptions import NotFound
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    Image = None
+
+CHUNK_SIZE = 64 * 1024
+# Names derived from the content never change meaning, so they can be cached forever.
+HASHED_NAME_RE = re.compile(r'^[0-9a-f]{32}(-[a-z]+)?\.[a-z]+$')
+SIGNATURES = {
+    'jpg': (b'\xff\xd8\xff',),
+    'jpeg': (b'\xff\xd8\xff',),
+    'png': (b'\x89PNG\r\n\x1a\n',),
+    'gif': (b'GIF87a', b'GIF89a'),
+    'webp': (b'RIFF',),
+}
+PIL_FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'gif': 'GIF', 'webp': 'WEBP'}
+
+
+def _extension(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+
+def _looks_like(extension, head):
+    return any(head.startswith(signature) for signature in SIGNATURES.get(extension, ()))
+
+
+def store_upload(storage):
+    """Stream an uploaded image to disk under a name derived from its content.
+
+    Returns ``(filename, created)``; an image that was uploaded before is not
+    stored again. Raises ``ValueError`` when the data is not the image its
+    extension claims to be.
+    """
+    upload_path = current_app.config['BLUELOG_UPLOAD_PATH']
+    extension = _extension(storage.filename)
+    if extension == 'jpeg':
+        extension = 'jpg'
+    tmp_path = os.path.join(upload_path, '.upload-%s.tmp' % uuid.uuid4().hex)
+    digest = hashlib.sha256()
+    try:
+        with open(tmp_path, 'wb') as f:
+            head = b''
+            while True:
+                chunk = storage.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if not head:
+                    head = chunk
+                digest.update(chunk)
+                f.write(chunk)
+        if not _looks_like(extension, head):
+            raise ValueError('Not a %s image' % extension.upper())
+        filename = '%s.%s' % (digest.hexdigest()[:32], extension)
+        path = os.path.join(upload_path, filename)
+        if os.path.exists(path):
+            return filename, False
+        os.replace(tmp_path, path)
+        return filename, True
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def variant_name(filename, variant=None, extension=None):
+    base, original = filename.rsplit('.', 1)
+    return '%s%s.%s' % (base, '-%s' % variant if variant else '', extension or original)
+
+
+def _save(image, path, format, quality):
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    if format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.save(tmp_path, format, quality=quality)
+    os.replace(tmp_path, path)
+
+
+def make_variants(upload_path, filename, variants, quality):
+    """Write the resized copies of an upload, each in its own format and as WebP."""
+    path = os.path.join(upload_path, filename)
+    with Image.open(path) as image:
+        if getattr(image, 'is_animated', False):
+            return
+        image = image.copy()
+    format = PIL_FORMATS[_extension(filename)]
+    if format != 'WEBP':
+        _save(image, os.path.join(upload_path, variant_name(filename, extension='webp')), 'WEBP', quality)
+    for variant, width in sorted(variants.items()):
+        if image.width <= width:
+            continue
+        resized = image.copy()
+        resized.thumbnail((width, image.height * width // image.width + 1), Image.LANCZOS)
+        _save(resized, os.path.join(upload_path, variant_name(filename, variant)), format, quality)
+        if format != 'WEBP':
+            _save(resized, os.path.join(upload_path, variant_name(filename, variant, 'webp')), 'WEBP', quality)
+
+
+def _executor(app):
+    state = app.extensions.setdefault('uploads', {})
+    if 'executor' not in state:
+        state['executor'] = ThreadPoolExecutor(app.config['BLUELOG_IMAGE_WORKERS'],
+                                               thread_name_prefix='bluelog-images')
+    return state['executor']
+
+
+def schedule_variants(filename):
+    """Generate the variants of ``filename`` in the background, or right away without workers."""
+    if Image is None:
+        return None
+    app = current_app._get_current_object()
+    args = (app.config['BLUELOG_UPLOAD_PATH'], filename, app.config['BLUELOG_IMAGE_VARIANTS'],
+            app.config['BLUELOG_IMAGE_QUALITY'])
+    if not app.config['BLUELOG_IMAGE_WORKERS']:
+        return make_variants(*args)
+
+    def report(future):
+        if future.exception() is not None:
+            app.logger.error('Could not resize %s: %s' % (filename, future.exception()))
+
+    future = _executor(app).submit(make_variants, *args)
+    future.add_done_callback(report)
+    return future
+
+
+def serve_upload(filename):
+    """Send an upload with validators and range support, or hand it to the front server.
+
+    A WebP variant is preferred for clients that name it in ``Accept``. Content addressed
+    names are cached for ``BLUELOG_UPLOAD_CACHE_TIMEOUT``, legacy names revalidate.
+    """
+    upload_path = current_app.config['BLUELOG_UPLOAD_PATH']
+    immutable = HASHED_NAME_RE.match(filename) is not None
+    if immutable and not filename.endswith('.webp') and 'image/webp' in request.headers.get('Accept', ''):
+        webp = variant_name(filename, extension='webp')
+        if os.path.isfile(os.path.join(upload_path, webp)):
+            filename = webp
+    path = safe_join(upload_path, filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+
+    cache_timeout = current_app.config['BLUELOG_UPLOAD_CACHE_TIMEOUT'] if immutable else 0
+    accel_prefix = current_app.config['BLUELOG_UPLOAD_ACCEL_PREFIX']
+    if accel_prefix:
+        # The front server (nginx) streams the file itself.
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + filename
+        response.headers['Content-Type'] = 'image/%s' % PIL_FORMATS.get(_extension(filename), 'jpeg').lower()
+    else:
+        response = send_from_directory(upload_path, filename, conditional=True, cache_timeout=cache_timeout)
+    if immutable:
+        response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % cache_timeout
+        response.vary.add('Accept')
+    else:
+        response.cache_control.no_cache = True
+    return response
@@ -9,7 +9,7 @@ def is_safe_url(target):
     return test_url.scheme in ('http', 'https') and ref_url.netloc == test_url.netloc
 
 
-def redirect_back(default='blog.html', **kwargs):
+def redirect_back(default='blog.index', **kwargs):
     for target in request.args.get('next'), request.referrer:
         if not target:
             continue
@@ -20,4 +20,4 @@ def redirect_back(default='blog.html', **kwargs):
 
 def allowed_file(filename):
     return '.' in filename and \
-        filename.rsplit('.', 1)[1].lower() in current_app.config['BLUELOG_ALLOWD_IMAGE_EXTENSIONS']
+        filename.rsplit('.', 1)[1].lower() in current_app.config['BLUELOG_ALLOWED_IMAGE_EXTENSIONS']
@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from bluelog import create_app
+from bluelog.benchmark import reads_during_write
+from bluelog.database import engine_options
+from bluelog.extensions import db
+from bluelog.settings import ProductionConfig
+
+
+class SQLitePragmasTestCase(unittest.TestCase):
+    """With the production pragmas a held write lock does not block readers."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='bluelog-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def create_app(self, pragmas):
+        app = create_app('testing')
+        app.config.update(
+            SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(self.workdir, 'test.db'),
+            BLUELOG_SQLITE_PRAGMAS=pragmas,
+        )
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(dict(app.config, SQLALCHEMY_ENGINE_OPTIONS=None))
+        with app.app_context():
+            db.create_all()
+        return app
+
+    def test_readers_pass_a_write_lock(self):
+        app = self.create_app(ProductionConfig.BLUELOG_SQLITE_PRAGMAS)
+        self.assertTrue(reads_during_write(app))
+
+    def test_rollback_journal_blocks_readers(self):
+        app = self.create_app({})
+        self.assertFalse(reads_during_write(app))
+
+
+if __name__ == '__main__':
+    unittest.main()
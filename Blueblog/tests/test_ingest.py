@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from bluelog import create_app, ingest
+from bluelog.database import engine_options
+from bluelog.extensions import db
+from bluelog.fakes import fake_admin, fake_category, fake_post
+from bluelog.models import Comment, Post
+
+
+class CommentIngestTestCase(unittest.TestCase):
+    """Comments posted concurrently through the memory buffer are all written, in batches."""
+
+    posters = 4
+    comments_per_poster = 25
+    batch_size = 10
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='bluelog-test-')
+        self.app = create_app('testing')
+        self.app.config.update(
+            SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(self.workdir, 'test.db'),
+            BLUELOG_COMMENT_BUFFER='memory',
+            BLUELOG_COMMENT_BATCH_SIZE=self.batch_size,
+            # Only a full batch wakes the writer up, the rest is written when it stops.
+            BLUELOG_COMMENT_FLUSH_INTERVAL=60,
+        )
+        self.app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+            dict(self.app.config, SQLALCHEMY_ENGINE_OPTIONS=None))
+        with self.app.app_context():
+            db.create_all()
+            fake_admin()
+            fake_category(1, seed=1)
+            fake_post(1, seed=1)
+            self.post_id = db.session.query(Post.id).scalar()
+
+    def tearDown(self):
+        ingest.stop_flusher(self.app)
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_concurrent_posters(self):
+        batches, statuses = [], []
+        lock = threading.Lock()
+        insert = ingest._insert
+
+        def record(items):
+            with lock:
+                batches.append(len(items))
+            return insert(items)
+
+        def post(poster):
+            client = self.app.test_client()
+            for i in range(self.comments_per_poster):
+                response = client.post('/post/%d' % self.post_id, data=dict(
+                    author='Poster %d' % poster, email='poster%d@example.com' % poster, site='',
+                    body='Comment %d' % i))
+                with lock:
+                    statuses.append(response.status_code)
+
+        with mock.patch.object(ingest, '_insert', record):
+            threads = [threading.Thread(target=post, args=(i,)) for i in range(self.posters)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            ingest.stop_flusher(self.app)
+            with self.app.app_context():
+                ingest.drain()
+
+        total = self.posters * self.comments_per_poster
+        self.assertEqual(statuses, [302] * total)
+        with self.app.app_context():
+            self.assertEqual(Comment.query.filter_by(post_id=self.post_id).count(), total)
+        self.assertEqual(sum(batches), total)
+        self.assertLess(len(batches), total)
+        self.assertTrue(all(size <= self.batch_size for size in batches))
+
+
+if __name__ == '__main__':
+    unittest.main()
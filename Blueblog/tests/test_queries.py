@@ -0,0 +1,59 @@
+import unittest
+
+from bluelog import create_app
+from bluelog.benchmark import QueryCounter
+from bluelog.extensions import db
+from bluelog.fakes import fake_admin, fake_category, fake_post, fake_comments, rebuild_aggregates
+from bluelog.models import Category
+
+
+class QueryCountTestCase(unittest.TestCase):
+    """The list pages issue as many queries for a few rows as for many."""
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.context = self.app.test_request_context()
+        self.context.push()
+        db.create_all()
+        fake_admin()
+        fake_category(5, seed=1)
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data=dict(username='admin', password='fakeadmin'))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def grow(self, posts, comments, seed):
+        fake_post(posts, seed=seed)
+        fake_comments(comments, seed=seed)
+        rebuild_aggregates()
+
+    def count_queries(self):
+        category_id = db.session.query(Category.id).order_by(Category.post_count.desc()).first()[0]
+        urls = {
+            'blog.index': '/',
+            'blog.show_category': '/category/%d' % category_id,
+            'admin.manage_post': '/admin/post/manage',
+            'admin.manage_comment': '/admin/comment/manage',
+        }
+        counts = {}
+        for name, url in urls.items():
+            # The first request fills the site cache, the second one is counted.
+            self.client.get(url)
+            with QueryCounter(db.engine) as counter:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, name)
+            counts[name] = counter.count
+        return counts
+
+    def test_query_count_does_not_grow_with_rows(self):
+        self.grow(20, 100, seed=1)
+        few = self.count_queries()
+        self.grow(400, 4000, seed=2)
+        self.assertEqual(self.count_queries(), few)
+
+
+if __name__ == '__main__':
+    unittest.main()